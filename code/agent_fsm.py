@@ -1,4 +1,5 @@
 import apis
+from transition_classifier import TransitionClassifier
 
 class AgentFSM:
     """
@@ -10,18 +11,26 @@ class AgentFSM:
     - mood_list: 可能的心情状态列表 (字符串列表)
     - emoji_list: 与心情状态对应的emoji表情符号列表 (字符串列表)
     - action_state_list: 可能的行动状态列表 (字符串列表)
+    - mood_classifier / action_state_classifier: 基于嵌入向量的本地转移分类器 (TransitionClassifier)，为 None 时总是调用LLM
 
     方法:
-    - __init__(initial_mood, initial_action_state, mood_list, emoji_list, action_state_list): 初始化代理的心情和行动状态。
+    - __init__(initial_mood, initial_action_state, mood_list, emoji_list, action_state_list, use_classifier): 初始化代理的心情和行动状态。
     - mood_transition(trigger, thought): 根据触发因素和思考内容更新当前的心情状态。
     - determine_mood_transition(trigger, thought): 根据触发事件和角色的思考来确定角色的新心情状态。
+    - set_mood(new_mood, trigger): 校验并设置新的心情状态。
     - get_current_emoji(): 根据当前心情状态获取对应的emoji表情符号。
     - action_state_transition(trigger, thought): 根据触发事件和角色的思考来更新角色的行动状态。
     - determine_action_state_transition(trigger, thought): 根据触发事件和角色的思考来确定角色的新行动状态。
+    - set_action_state(new_action_state, trigger): 校验并设置新的行动状态。
+    - classify_transition(kind, trigger, thought): 只用本地分类器判断 "mood" 或 "action_state" 的转移。
+    - record_transition(kind, query_embedding, state): 记录一次由其他途径（例如LLM）确定的转移，用于拟合分类器。
 
-    使用这个类可以模拟一个角色的情绪和行动状态的变化，其中心情和行动状态的转变是通过与ChatGPT API的交互来确定的。每当有一个新的触发事件和角色的思考时，可以调用相应的方法来更新代理的状态。
+    使用这个类可以模拟一个角色的情绪和行动状态的变化。心情和行动状态的转变先由本地转移分类器根据“当前状态+事件+想法”的嵌入向量判断，
+    分类器的阈值尚未由LLM决策校准、或者把握不足时才与ChatGPT API交互来确定，LLM给出的合法结果会被记录下来用于校准和拟合分类器。
+    每当有一个新的触发事件和角色的思考时，可以调用相应的方法来更新代理的状态。
     """
-    def __init__(self, initial_mood, initial_action_state, mood_list, emoji_list, action_state_list):
+    def __init__(self, initial_mood, initial_action_state, mood_list, emoji_list, action_state_list,
+                 use_classifier=True):
         # 状态
         self.mood = initial_mood
         self.action_state = initial_action_state
@@ -31,6 +40,50 @@ class AgentFSM:
         self.emoji_list = emoji_list
         self.action_state_list = action_state_list
 
+        # 本地转移分类器，状态名称的嵌入向量在第一次转移时获取
+        self.mood_classifier = TransitionClassifier(mood_list, "心情：{}") if use_classifier else None
+        self.action_state_classifier = TransitionClassifier(action_state_list, "行动：{}") if use_classifier else None
+
+    def _transition_embedding(self, kind, trigger, thought):
+        """获取“当前状态+事件+想法”的嵌入向量，与LLM提示词一样包含 kind 对应的当前状态。失败时返回 None。"""
+        current = f"角色当前心情：{self.mood}" if kind == "mood" else f"角色当前行动状态：{self.action_state}"
+        try:
+            embeddings = apis.request_embedding(f"{current}\n观察到的事件：{trigger}\n角色的想法：{thought}",
+                                                priority=apis.PRIORITY_BACKGROUND)
+        except Exception as e:
+            print(f"获取转移嵌入向量时发生错误：{e}")
+            return None
+        return embeddings[0] if embeddings else None
+
+    def classify_transition(self, kind, trigger, thought):
+        """
+        只用本地分类器判断转移，不调用LLM。
+
+        输入:
+        - kind: "mood" 或 "action_state"
+        - trigger: 触发状态转变的事件或情况 (字符串)
+        - thought: 角色对触发事件的思考或解读 (字符串)
+
+        输出:
+        - (state, query_embedding): 分类器可信（见 TransitionClassifier.trusts）时 state 为分类结果，否则为 None；
+          query_embedding 用于记录其他途径确定的结果。
+        """
+        classifier = getattr(self, f"{kind}_classifier")
+        if classifier is None:
+            return None, None
+        query_embedding = self._transition_embedding(kind, trigger, thought)
+        state, margin = classifier.predict(query_embedding)
+        if classifier.trusts(state, margin):
+            print(f"分类器推理出的{kind}为:{state}（margin={margin:.3f}），跳过LLM请求。")
+            return state, query_embedding
+        return None, query_embedding
+
+    def record_transition(self, kind, query_embedding, state):
+        """记录一次由其他途径（例如LLM）确定的 "mood" 或 "action_state" 转移，不合法的状态被忽略。"""
+        classifier = getattr(self, f"{kind}_classifier")
+        if classifier is not None:
+            classifier.record(query_embedding, state)
+
     def mood_transition(self, trigger, thought):
         """
        根据触发因素和思考内容更新当前的心情状态。
@@ -50,8 +103,20 @@ class AgentFSM:
             print("错误：'mood_list'属性不存在或不是列表类型。")
             return None
 
-        # 确定新的心情状态
-        new_mood = self.determine_mood_transition(trigger, thought)
+        # 确定并设置新的心情状态
+        self.set_mood(self.determine_mood_transition(trigger, thought), trigger)
+
+    def set_mood(self, new_mood, trigger):
+        """
+        校验并设置新的心情状态。
+
+        输入:
+        - new_mood: 新的心情状态 (字符串)，不在心情列表中时不发生转移
+        - trigger: 触发心情转变的事件或情况 (字符串)，用于打印
+
+        输出:
+        - bool: 是否发生了心情转移
+        """
         # 获取当前心情状态
         old_mood = self.mood
 
@@ -61,9 +126,10 @@ class AgentFSM:
             self.mood = new_mood
             # 打印心情转移信息
             print(f"心情从{old_mood}转移至：{self.mood}，因为发生了：{trigger}")
-        else:
-            # 打印错误信息
-            print(f"收到不明确的心情：{new_mood}。没有发生心情转移。")
+            return True
+        # 打印错误信息
+        print(f"收到不明确的心情：{new_mood}。没有发生心情转移。")
+        return False
 
     def determine_mood_transition(self, trigger, thought):
         """
@@ -76,6 +142,16 @@ class AgentFSM:
         输出:
         - new_mood: 推理出的新心情状态 (字符串)
         """
+        new_mood, query_embedding = self.classify_transition("mood", trigger, thought)
+        if new_mood is not None:
+            return new_mood
+
+        new_mood = self._request_mood_transition(trigger, thought)
+        self.record_transition("mood", query_embedding, new_mood)
+        return new_mood
+
+    def _request_mood_transition(self, trigger, thought):
+        """通过LLM推理新心情状态，结果不在心情列表中时返回 None。"""
         # 构建推理心情转移的提示信息
         mood_transition_prompt = f"""
 任务：推理角色的下一个心情应该是什么。心情可以是不变的。下面有一个例子给你作为参考，实际推理和例子无关。
@@ -93,7 +169,8 @@ class AgentFSM:
 
         # 发送请求并获取响应
         try:
-            response = apis.request_chatgpt(mood_transition_prompt, temperature=0.5)
+            response = apis.request_chatgpt(mood_transition_prompt, temperature=0.5, use_cache=True,
+                                           priority=apis.PRIORITY_BACKGROUND)
         except Exception as e:
             print(f"请求处理过程中发生错误：{e}")
             return None
@@ -147,13 +224,26 @@ class AgentFSM:
         输出:
         - 无 (直接更新类实例的状态)
         """
-        new_action_state = self.determine_action_state_transition(trigger, thought)
+        self.set_action_state(self.determine_action_state_transition(trigger, thought), trigger)
+
+    def set_action_state(self, new_action_state, trigger):
+        """
+        校验并设置新的行动状态。
+
+        输入:
+        - new_action_state: 新的行动状态 (字符串)，不在行动列表中时不发生转移
+        - trigger: 触发行动状态转变的事件或情况 (字符串)，用于打印
+
+        输出:
+        - bool: 是否发生了行动状态转移
+        """
         old_action_state = self.action_state
         if new_action_state in self.action_state_list:
             self.action_state = new_action_state
             print(f"行动状态从{old_action_state}转移至：{self.action_state}。\n因为发生了：{trigger}")
-        else:
-            print(f"收到不明确的行动状态：{new_action_state}。没有发生行动状态转移。")
+            return True
+        print(f"收到不明确的行动状态：{new_action_state}。没有发生行动状态转移。")
+        return False
 
     def determine_action_state_transition(self, trigger, thought):
         """
@@ -166,6 +256,16 @@ class AgentFSM:
         输出:
         - new_action_state: 推理得出的新行动状态 (字符串)
         """
+        new_action_state, query_embedding = self.classify_transition("action_state", trigger, thought)
+        if new_action_state is not None:
+            return new_action_state
+
+        new_action_state = self._request_action_state_transition(trigger, thought)
+        self.record_transition("action_state", query_embedding, new_action_state)
+        return new_action_state
+
+    def _request_action_state_transition(self, trigger, thought):
+        """通过LLM推理新行动状态。"""
         # 构造中文提示文本
         action_state_transition_prompt = f"""
 任务：推理角色的下一个行动应该是什么。下一个行动可以是不变的。下面有一个例子给你作为参考，实际推理和例子无关。
@@ -180,7 +280,8 @@ class AgentFSM:
 精确地输出行动名称，不要进行额外的输出。
 """
         print(action_state_transition_prompt)
-        response = apis.request_chatgpt(action_state_transition_prompt, temperature=0.5)
+        response = apis.request_chatgpt(action_state_transition_prompt, temperature=0.5, use_cache=True,
+                                       priority=apis.PRIORITY_BACKGROUND)
         print(f"输出状态为:{response}")
         new_action_state = response.strip()
         return new_action_state
@@ -0,0 +1,245 @@
+import os
+import json
+import numpy as np
+
+# k-means 训练时每次参与矩阵乘法的最大行数，限制临时内存
+ASSIGN_CHUNK_SIZE = 65536
+
+
+def _normalize(vectors):
+    """按行归一化为 float32，零向量保持为零。"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _nearest_centroids(vectors, centroids):
+    """分块计算每个向量最近（内积最大）的聚类中心。"""
+    assign = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_SIZE):
+        chunk = vectors[start:start + ASSIGN_CHUNK_SIZE]
+        assign[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assign
+
+
+def spherical_kmeans(vectors, n_clusters, iterations=10, seed=0):
+    """
+    在归一化向量上运行球面 k-means（以内积作为相似度，聚类中心保持单位长度）。
+
+    参数:
+    vectors (np.ndarray): 已归一化的向量矩阵。
+    n_clusters (int): 聚类数量。
+    iterations (int): 迭代次数。
+    seed (int): 随机种子。
+
+    返回:
+    np.ndarray: 形状为 (n_clusters, dim) 的聚类中心矩阵。
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = _nearest_centroids(vectors, centroids)
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+
+        # 空聚类重新随机取一个样本作为中心，避免聚类数量塌缩
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    IVFIndex 类是一个纯 NumPy 实现的倒排文件（IVF）近似最近邻索引。
+
+    向量先用球面 k-means 划分到 n_lists 个倒排列表中。查询时只扫描与查询向量最接近的 nprobe 个列表，
+    nprobe 越大召回越高、延迟越大；nprobe 等于 n_lists 时退化为精确搜索。
+
+    每个向量带有两个整数标识：root_id（根知识在 basic_knowledge 中的索引）和 sub_id
+    （子知识在子知识文件中的索引，根知识本身为 -1）。
+
+    方法:
+    - train(vectors, n_lists): 训练聚类中心。
+    - add(vectors, root_ids, sub_ids): 增量添加向量。
+    - remove_root(root_id, shift): 删除某个根知识及其子知识的所有向量。
+    - search(query_embedding, top_k, nprobe): 近似搜索。
+    - save(path) / load(path): 持久化到 .npz 文件。
+    """
+    def __init__(self, centroids=None):
+        self.centroids = None
+        self.dim = None
+        self._vectors = []
+        self._root_ids = []
+        self._sub_ids = []
+        # 子知识文件的 (mtime_ns, size)，用于发现索引之外对子知识文件的修改
+        self.sources = {}
+        self.dirty = False
+        if centroids is not None:
+            self._set_centroids(centroids)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._root_ids)
+
+    @property
+    def n_lists(self):
+        return 0 if self.centroids is None else len(self.centroids)
+
+    def _set_centroids(self, centroids):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.dim = self.centroids.shape[1]
+        self._vectors = [np.empty((0, self.dim), dtype=np.float32) for _ in range(self.n_lists)]
+        self._root_ids = [np.empty(0, dtype=np.int64) for _ in range(self.n_lists)]
+        self._sub_ids = [np.empty(0, dtype=np.int64) for _ in range(self.n_lists)]
+
+    def root_count(self):
+        """索引中根知识向量（sub_id 为 -1）的数量。"""
+        return sum(int((ids == -1).sum()) for ids in self._sub_ids)
+
+    def train(self, vectors, n_lists=None, iterations=10, max_training_points=256, seed=0):
+        """
+        用一批向量训练聚类中心，会清空已添加的向量。
+
+        参数:
+        vectors: 训练向量。
+        n_lists (int): 倒排列表数量，默认取 sqrt(N)。
+        iterations (int): k-means 迭代次数。
+        max_training_points (int): 每个列表最多使用的训练样本数，超过时随机采样。
+        seed (int): 随机种子。
+        """
+        vectors = _normalize(vectors)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+
+        sample_size = n_lists * max_training_points
+        if len(vectors) > sample_size:
+            rng = np.random.default_rng(seed)
+            vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        self._set_centroids(spherical_kmeans(vectors, n_lists, iterations, seed))
+        self.dirty = True
+
+    def add(self, vectors, root_ids, sub_ids):
+        """
+        增量添加向量，每个向量被分配到最近的倒排列表。
+
+        参数:
+        vectors: 向量矩阵。
+        root_ids: 每个向量所属根知识的索引。
+        sub_ids: 每个向量在子知识文件中的索引，根知识本身为 -1。
+        """
+        if self.centroids is None:
+            raise ValueError("IVFIndex 尚未训练，无法添加向量")
+        vectors = _normalize(vectors)
+        if len(vectors) == 0:
+            return
+        root_ids = np.asarray(root_ids, dtype=np.int64)
+        sub_ids = np.asarray(sub_ids, dtype=np.int64)
+        assign = _nearest_centroids(vectors, self.centroids)
+        for list_id in np.unique(assign):
+            mask = assign == list_id
+            self._vectors[list_id] = np.concatenate([self._vectors[list_id], vectors[mask]])
+            self._root_ids[list_id] = np.concatenate([self._root_ids[list_id], root_ids[mask]])
+            self._sub_ids[list_id] = np.concatenate([self._sub_ids[list_id], sub_ids[mask]])
+        self.dirty = True
+
+    def remove_root(self, root_id, shift=True, children_only=False):
+        """
+        删除某个根知识的向量。
+
+        参数:
+        root_id (int): 根知识索引。
+        shift (bool): 为 True 时，把大于 root_id 的索引减一，与 basic_knowledge 中的删除保持一致。
+        children_only (bool): 为 True 时只删除子知识向量，保留根知识本身。
+        """
+        for list_id in range(self.n_lists):
+            root_ids = self._root_ids[list_id]
+            remove = root_ids == root_id
+            if children_only:
+                remove &= self._sub_ids[list_id] >= 0
+            if remove.any():
+                keep = ~remove
+                self._vectors[list_id] = self._vectors[list_id][keep]
+                self._sub_ids[list_id] = self._sub_ids[list_id][keep]
+                root_ids = root_ids[keep]
+            if shift:
+                root_ids = np.where(root_ids > root_id, root_ids - 1, root_ids)
+            self._root_ids[list_id] = root_ids
+        self.dirty = True
+
+    def search(self, query_embedding, top_k=1, nprobe=8):
+        """
+        近似搜索与查询向量最相似的 top_k 个向量。
+
+        参数:
+        query_embedding: 查询向量。
+        top_k (int): 返回数量。
+        nprobe (int): 扫描的倒排列表数量，召回率/延迟的调节旋钮。
+
+        返回:
+        list: 按相似度降序排列的 (root_id, sub_id, score) 元组列表，根知识本身的 sub_id 为 -1。
+        """
+        if self.centroids is None or top_k <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.shape != (self.dim,) or not np.linalg.norm(query):
+            return []
+        query = query / np.linalg.norm(query)
+
+        nprobe = max(1, min(nprobe, self.n_lists))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+
+        scores, root_ids, sub_ids = [], [], []
+        for list_id in probe:
+            if len(self._root_ids[list_id]):
+                scores.append(self._vectors[list_id] @ query)
+                root_ids.append(self._root_ids[list_id])
+                sub_ids.append(self._sub_ids[list_id])
+        if not scores:
+            return []
+
+        scores = np.concatenate(scores)
+        root_ids = np.concatenate(root_ids)
+        sub_ids = np.concatenate(sub_ids)
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(root_ids[i]), int(sub_ids[i]), float(scores[i])) for i in top]
+
+    def save(self, path):
+        """把索引保存到 .npz 文件。先写临时文件再原子替换，崩溃时不会留下损坏的索引。"""
+        sizes = np.array([len(ids) for ids in self._root_ids], dtype=np.int64)
+        # 多个进程可能同时建立并保存同一个索引，临时文件按进程区分
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as file:
+            np.savez(file,
+                     centroids=self.centroids,
+                     vectors=np.concatenate(self._vectors) if self._vectors else np.empty((0, 0), np.float32),
+                     root_ids=np.concatenate(self._root_ids) if self._root_ids else np.empty(0, np.int64),
+                     sub_ids=np.concatenate(self._sub_ids) if self._sub_ids else np.empty(0, np.int64),
+                     list_sizes=sizes,
+                     sources=np.array(json.dumps(self.sources, ensure_ascii=False)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        """从 .npz 文件加载索引。"""
+        with np.load(path) as data:
+            index = cls(data["centroids"])
+            offsets = np.cumsum(data["list_sizes"])[:-1]
+            index._vectors = np.split(data["vectors"], offsets)
+            index._root_ids = np.split(data["root_ids"], offsets)
+            index._sub_ids = np.split(data["sub_ids"], offsets)
+            index.sources = {path: tuple(signature)
+                             for path, signature in json.loads(str(data["sources"])).items()}
+        return index
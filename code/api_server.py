@@ -0,0 +1,266 @@
+import os
+import json
+import asyncio
+import logging
+import contextlib
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+import apis
+from perception import Perception
+from brain import Brain
+from memory_consolidator import MemoryConsolidator
+from session_manager import SessionManager
+
+# 角色的初始化文件
+AGENT_JSON_PATH = os.environ.get("LUCY_AGENT_JSON", "../resource/hutao.json")
+API_HOST = os.environ.get("LUCY_API_HOST", "0.0.0.0")
+API_PORT = int(os.environ.get("LUCY_API_PORT", "8000"))
+# uvicorn 工作进程数量。每个进程加载一份大脑；多于一个进程时各进程只读加载知识库，知识注入接口不可用，
+# 会话需要由负载均衡按 session_id 粘滞到同一个进程（被换出的会话通过共享的会话目录在进程之间迁移）
+API_WORKERS = int(os.environ.get("LUCY_API_WORKERS", "1"))
+# 为 True 时丢弃保存的快照和日志，从初始化文件重新开始（与 web_demo 相同）
+RESET_BRAIN = os.environ.get("LUCY_RESET_BRAIN") == "1"
+# 知识文本超过该长度时先切分为子知识，与 web_demo 相同
+MAX_KNOWLEDGE_UNIT_LENGTH = 500
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRequest(BaseModel):
+    session_id: str
+    query: str
+    # 为 True 时以 Server-Sent Events 逐段返回回复
+    stream: bool = False
+
+
+class PerceiveRequest(BaseModel):
+    session_id: str
+    trigger: str
+
+
+class KnowledgeRequest(BaseModel):
+    text: str
+    # 文本较长需要切分时作为根知识的总结文本
+    summary_text: Optional[str] = None
+
+
+def classifier_paths(brain):
+    """返回 FSM 的两个状态转移分类器及其样本文件路径。"""
+    return [(getattr(brain.fsm, f"{kind}_classifier"), f"../resource/{brain.name}_{kind}_transitions.npz")
+            for kind in ("mood", "action_state")]
+
+
+def load_brain(writable):
+    """
+    加载基础大脑：知识库、近似索引、嵌入矩阵和转移分类器的样本。
+
+    大脑从快照和预写日志恢复（见 Brain.load_persisted），第一次运行或设置了 LUCY_RESET_BRAIN=1 时从 AGENT_JSON_PATH 开始。
+
+    参数:
+    writable (bool): 为 True 时挂接预写日志（只能有一个进程这样做），否则只读取快照和日志，基础大脑的修改不持久化。
+                     后台记忆整理器总是启动，它同时整理由基础大脑 fork 出的所有会话大脑。
+
+    异常:
+    JournalInUseError: writable 为 True 而快照和日志正在被另一个进程（例如 web_demo）使用。
+                       两者共用 ../resource 下同一份快照和日志，同时写入会互相破坏持久化的状态，所以拒绝启动。
+    """
+    with open(AGENT_JSON_PATH, "r", encoding="utf-8") as json_file:
+        brain = Brain.load_persisted(json.load(json_file), writable=writable, reset=RESET_BRAIN)
+    consolidator = MemoryConsolidator(brain)
+    consolidator.start()
+    # 近似索引随知识的增删由可写进程保存；不存在或与知识库不一致时在后台重新建立
+    brain.ensure_ann_index()
+    brain.warm_up()
+    brain.cot_single_call = True
+    for classifier, path in classifier_paths(brain):
+        if classifier is not None and os.path.exists(path):
+            classifier.load(path)
+    return brain, consolidator
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # 每个 uvicorn 工作进程各自在启动时加载大脑，导入模块本身不加载
+    brain, consolidator = load_brain(writable=API_WORKERS == 1)
+    app.state.brain = brain
+    app.state.sessions = SessionManager(brain)
+    app.state.knowledge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="knowledge_ingest")
+    logger.info(f"API服务加载了{brain.name}的大脑，工作进程数：{API_WORKERS}")
+    try:
+        yield
+    finally:
+        app.state.sessions.close()
+        app.state.knowledge_executor.shutdown(wait=True)
+        consolidator.stop()
+        if brain.journal is not None:
+            # 只有可写的进程保存分类器的样本，避免多个进程互相覆盖
+            for classifier, path in classifier_paths(brain):
+                if classifier is not None:
+                    classifier.save(path)
+            brain.journal.close()
+
+
+app = FastAPI(title="LucyAgent", lifespan=lifespan)
+
+
+def _state(session_brain):
+    return {
+        "mood": session_brain.fsm.mood,
+        "emoji": session_brain.fsm.get_current_emoji(),
+        "action_state": session_brain.fsm.action_state,
+    }
+
+
+@contextlib.asynccontextmanager
+async def _session(session_id):
+    """
+    取出会话并在 async with 块执行期间阻止它被换出。取出会话可能需要从磁盘换入、换出其他会话，在线程中执行，
+    不阻塞事件循环。
+    """
+    context = app.state.sessions.session(session_id)
+    session = await asyncio.to_thread(context.__enter__)
+    try:
+        yield session
+    finally:
+        context.__exit__(None, None, None)
+
+
+async def _update_after_chat(session, query, thought, response):
+    """在会话的记账队列中创建记忆并进行心情转移，在事件循环中等待完成。"""
+    perception_text = f"{session.brain.name}收到了来自hadi的询问：{query}"
+    output_text = f"进行了思考：{thought},做出了回复：{response}"
+    await asyncio.wrap_future(session.submit(session.brain.update_state_after_turn, perception_text, output_text,
+                                             thought, ("mood",)))
+
+
+def _remember(session, perception_text, output_text, summary):
+    """后台任务：用合并调用生成的记忆总结为会话创建记忆，没有调用者等待，错误只记录日志。"""
+    try:
+        session.brain.remember_after_turn(perception_text, output_text, summary)
+    except Exception as e:
+        logger.error(f"会话 {session.session_id} 创建记忆时发生错误：{e}")
+
+
+def _sse(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.post("/chat")
+async def chat(request: ChatRequest):
+    """
+    和角色对话（async_cot_chat）。对话历史保存在服务端的会话中。嵌入和LLM请求在事件循环中 await，
+    并发由 apis 的请求调度器控制，不占用线程池。
+
+    stream 为 False 时返回 {"response", "thought", "mood", "emoji", "action_state"}；为 True 时以 SSE 返回
+    {"delta": 新增的回复} 事件，最后一个事件为 {"done": true, "response": 完整回复, 以及状态字段}。
+    """
+    if not request.query:
+        raise HTTPException(status_code=400, detail="query 不能为空")
+
+    if not request.stream:
+        async with _session(request.session_id) as session:
+            history = session.history + [[request.query, None]]
+            response, _, thought = await session.brain.async_cot_chat(request.query, history)
+            history[-1][1] = response
+            session.history = history
+            await _update_after_chat(session, request.query, thought, response)
+            return {"response": response, "thought": thought, **_state(session.brain)}
+
+    async def events():
+        async with _session(request.session_id) as session:
+            history = session.history + [[request.query, None]]
+            response, thought = "", ""
+            async for response, _, thought in session.brain.async_cot_chat_stream(request.query, history):
+                delta = response[len(history[-1][1] or ""):]
+                history[-1][1] = response
+                if delta:
+                    yield _sse({"delta": delta})
+            session.history = history
+            await _update_after_chat(session, request.query, thought, response)
+            yield _sse({"done": True, "response": response, **_state(session.brain)})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/perceive")
+async def perceive(request: PerceiveRequest):
+    """
+    让角色感知一个事件：生成内心想法，创建记忆并转移行动状态。
+
+    返回 {"thought", "old_action_state", "action_state", "mood", "emoji"}。
+    """
+    if not request.trigger:
+        raise HTTPException(status_code=400, detail="trigger 不能为空")
+    async with _session(request.session_id) as session:
+        session_brain = session.brain
+        old_action_state = session_brain.fsm.action_state
+        thought = await session_brain.async_create_thought_from_perception(request.trigger)
+        output_text = f"{session_brain.name}进行了思考：{thought}"
+        # 只等待合并调用和行动状态的转移；记忆的嵌入请求和加入记忆流在会话的记账队列中执行，不等待
+        summary = await asyncio.to_thread(session_brain.transit_after_turn, request.trigger, output_text, thought,
+                                          ("action_state",))
+        session.submit(_remember, session, request.trigger, output_text, summary)
+        return {"thought": thought, "old_action_state": old_action_state, **_state(session_brain)}
+
+
+def _ingest_knowledge(brain, text, summary_text):
+    """把知识文本加入共享知识库；文本较长时切分为子知识文件。"""
+    if len(text) <= MAX_KNOWLEDGE_UNIT_LENGTH:
+        knowledge = brain.add_knowledge_from_text(text)
+        return {"root_text": knowledge["text"], "sub_knowledge": None, "units": 0}
+
+    segments = Perception.split_text(text, min_length=MAX_KNOWLEDGE_UNIT_LENGTH,
+                                     buffer_min_length=int(MAX_KNOWLEDGE_UNIT_LENGTH * 0.3))
+    knowledge_list = Perception.generate_knowledge_units(segments)
+    sub_knowledge_file = brain.add_knowledge_from_sub_knowledge_list(summary_text, knowledge_list)
+    if sub_knowledge_file is None:
+        raise HTTPException(status_code=500, detail="写入子知识文件失败")
+    return {"root_text": summary_text, "sub_knowledge": sub_knowledge_file, "units": len(knowledge_list)}
+
+
+@app.post("/knowledge")
+async def add_knowledge(request: KnowledgeRequest):
+    """
+    向所有会话共享的知识库注入知识。知识注入在单线程的执行器中按顺序执行，事件循环只等待结果，只在单进程部署时可用。
+
+    返回 {"root_text", "sub_knowledge": 子知识文件路径或None, "units": 子知识数量}。
+    """
+    if API_WORKERS != 1:
+        raise HTTPException(status_code=503, detail="多进程部署时知识库只读，请通过单进程实例注入知识")
+    if not request.text:
+        raise HTTPException(status_code=400, detail="text 不能为空")
+    if len(request.text) > MAX_KNOWLEDGE_UNIT_LENGTH and not request.summary_text:
+        raise HTTPException(status_code=400, detail="文本较长需要切分，请提供 summary_text")
+    future = app.state.knowledge_executor.submit(_ingest_knowledge, app.state.brain, request.text,
+                                                 request.summary_text)
+    return await asyncio.wrap_future(future)
+
+
+@app.get("/state")
+async def state(session_id: str):
+    """
+    返回会话的心情、行动状态和记忆条数，以及共享知识库、会话管理器和接口调度器（排队深度等）的统计信息。
+    scheduler 合并了服务事件循环（对话请求）和 apis 后台事件循环（会话记账等同步调用）上的调度器。
+    """
+    async with _session(session_id) as session:
+        return {
+            **_state(session.brain),
+            "memory_count": len(session.brain.memory_stream),
+            "knowledge_count": len(app.state.brain.basic_knowledge),
+            "sessions": app.state.sessions.stats(),
+            "scheduler": apis.api_client.stats(),
+        }
+
+
+if __name__ == "__main__":
+    # 多个工作进程时 uvicorn 需要以导入字符串的形式引用应用
+    uvicorn.run("api_server:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
@@ -1,34 +1,499 @@
 import os
 import re
 import json
+import random
+import asyncio
+import threading
+import importlib.util
+import time
+import heapq
+import weakref
+import itertools
+import contextlib
+from collections import deque
 import openai
-import requests
+import httpx
 from gradio_client import Client
+from embedding_cache import EmbeddingCache
+from embedding_batcher import EmbeddingBatcher
+from response_cache import ResponseCache
 
 # openai接入点
 openai_api_base = "https://api.openai.com/v1/embeddings"
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
 # TTS和搜索服务接入点
+tts_api_base = "https://tts.ai-lab.top"
 tts_api_key = os.getenv('TTS_API_KEY')
+bing_api_base = "https://api.bing.microsoft.com/v7.0/search"
 bing_api_key = os.getenv('BING_API_KEY')
 
 # easygpt接入点
 easygpt_api_base = "https://chat.eqing.tech/v1/chat/completions"
 easygpt_api_key = os.getenv('EASYGPT_API_KEY')
 
-def request_chatgpt(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygpt_api_base):
+# 嵌入向量缓存，按模型名区分命名空间。设置 EMBEDDING_CACHE_PATH 为空字符串可以关闭缓存
+EMBEDDING_MODEL = "text-embedding-ada-002"
+embedding_cache_path = os.getenv('EMBEDDING_CACHE_PATH', "../resource/embedding_cache.sqlite3")
+embedding_cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+
+# 单条文本的嵌入请求在这段时间（秒）内合并为一次批量请求，设置 EMBEDDING_BATCH_WAIT 为0可以关闭合并
+EMBEDDING_BATCH_MAX_WAIT = float(os.getenv('EMBEDDING_BATCH_WAIT', "0.005"))
+# 一次批量嵌入请求最多包含的文本条数，凑满后立即发出
+EMBEDDING_BATCH_MAX_SIZE = 64
+
+# LLM回复缓存，只用于低温度的内部调用。设置 RESPONSE_CACHE_PATH 为空字符串可以关闭缓存
+CHAT_MODEL = "gpt-3.5-turbo"
+# request_chatgpt 未指定 use_cache 时，temperature 不超过该值的调用才走缓存，高温度的角色回复默认不缓存
+CACHE_MAX_TEMPERATURE = 0.5
+response_cache_path = os.getenv('RESPONSE_CACHE_PATH', "../resource/response_cache.sqlite3")
+response_cache = ResponseCache(response_cache_path) if response_cache_path else None
+
+# 各接入点的并发上限和超时（秒）
+ENDPOINT_CONCURRENCY = {"chat": 8, "embedding": 16, "bing": 4, "tts": 2}
+ENDPOINT_TIMEOUTS = {"chat": 60.0, "embedding": 30.0, "bing": 10.0, "tts": 10.0}
+CONNECT_TIMEOUT = 10.0
+# 网络错误、429和5xx时的重试次数及指数退避的基准时间（秒）
+MAX_RETRIES = 3
+RETRY_BACKOFF_BASE = 0.5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 请求的优先级类别：用户正在等待的对话、回合后的状态更新（记忆、心情、行动状态）、批量知识导入
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+PRIORITY_BULK = "bulk"
+# 优先级的调度顺序，数值越小越先被调度
+PRIORITY_RANKS = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 1, PRIORITY_BULK: 2}
+# 各接入点每分钟的请求数（RPM）和token数（TPM）上限，None 表示不限制
+ENDPOINT_RATE_LIMITS = {"chat": (3500, 90000), "embedding": (3000, 1000000)}
+# 低优先级请求必须给高优先级请求留出的配额比例：获得调度后令牌桶和并发槽位中至少还剩下这部分
+PRIORITY_RESERVE = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BACKGROUND: 0.1, PRIORITY_BULK: 0.25}
+# 每个接入点各优先级最多排队的请求数，超过时立即拒绝（抛出 SchedulerOverloadedError），None 表示不限制
+MAX_QUEUE_DEPTH = {PRIORITY_INTERACTIVE: None, PRIORITY_BACKGROUND: 256, PRIORITY_BULK: 32}
+# 估算chat请求的token数时为回复预留的token数
+CHAT_COMPLETION_TOKENS = 256
+# 一次嵌入请求最多包含的文本条数，更多的文本分批依次请求，批次之间高优先级请求可以插队
+EMBEDDING_REQUEST_MAX_ITEMS = 64
+
+
+def estimate_tokens(text):
+    """粗略估算文本的token数：中文约一个字一个token，按字符数估算不会低估。"""
+    return len(text)
+
+
+class SchedulerOverloadedError(httpx.RequestError):
+    """请求的优先级队列已满，请求没有发出。"""
+
+
+class TokenBucket:
     """
-    以requests库的方式调用自定义接入点的GPT模型进行聊天。
+    TokenBucket 类是按分钟计算配额的令牌桶，容量为每分钟的配额，令牌按 配额/60 每秒的速度补充。可以被多个线程共享。
+
+    方法:
+    - wait_time(amount, reserve): 返回取出 amount 个令牌并至少剩下 reserve 个之前还需要等待的秒数。
+    - consume(amount): 取出令牌。
+    """
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, reserve=0.0):
+        with self._lock:
+            self._refill()
+            # 单个请求超过桶容量时按桶满计算，避免永远无法调度
+            needed = min(amount + reserve, self.capacity)
+            return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def consume(self, amount):
+        with self._lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+
+
+class RequestScheduler:
+    """
+    RequestScheduler 类在一个接入点的并发上限和 RPM/TPM 令牌桶之内，按优先级调度一个事件循环上的请求。
+
+    - 等待中的请求按 (优先级, 到达顺序) 排队，有空闲的并发槽位且令牌足够时队首的请求先被调度，
+      因此正在进行的批量导入不会让对话请求排在它后面。
+    - 低优先级请求只能使用 PRIORITY_RESERVE 之外的令牌和并发槽位，新到达的对话请求总有配额可用。
+    - 某个优先级排队的请求超过 MAX_QUEUE_DEPTH 时，新请求立即被拒绝（背压），而不是无限堆积。
+
+    方法:
+    - slot(priority, tokens): 异步上下文管理器，等待调度后占用一个并发槽位，退出时释放。
+    - stats(): 返回各优先级的排队数量、等待时间等统计信息。
+    """
+    def __init__(self, concurrency, request_bucket=None, token_bucket=None, max_queue_depth=None):
+        self.concurrency = concurrency
+        self.request_bucket = request_bucket
+        self.token_bucket = token_bucket
+        self.max_queue_depth = dict(MAX_QUEUE_DEPTH, **(max_queue_depth or {}))
+        self._queue = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._timer = None
+        self._depths = {priority: 0 for priority in PRIORITY_RANKS}
+        self._granted = {priority: 0 for priority in PRIORITY_RANKS}
+        self._rejected = {priority: 0 for priority in PRIORITY_RANKS}
+        # 各优先级最近的排队等待时间（秒），用于计算p95
+        self._waits = {priority: deque(maxlen=256) for priority in PRIORITY_RANKS}
+
+    def _reserved_slots(self, priority):
+        reserve = PRIORITY_RESERVE.get(priority, 0.0)
+        return min(self.concurrency - 1, int(self.concurrency * reserve + 0.999)) if reserve else 0
+
+    def _wait_time(self, priority, tokens):
+        """返回队首请求还需要等待令牌补充的秒数。"""
+        reserve = PRIORITY_RESERVE.get(priority, 0.0)
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = self.request_bucket.wait_time(1, reserve * self.request_bucket.capacity)
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(tokens, reserve * self.token_bucket.capacity))
+        return wait
+
+    def _dispatch(self):
+        """按优先级调度队首的请求，直到没有空闲槽位、令牌不足或队列为空。"""
+        self._timer = None
+        while self._queue:
+            _, _, priority, tokens, enqueued, future = self._queue[0]
+            if future.done():
+                # 等待中被取消的请求
+                heapq.heappop(self._queue)
+                continue
+            if self._active >= self.concurrency - self._reserved_slots(priority):
+                # 有请求完成时会再次调度
+                return
+            wait = self._wait_time(priority, tokens)
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(tokens)
+            self._active += 1
+            self._depths[priority] -= 1
+            self._granted[priority] += 1
+            self._waits[priority].append(time.monotonic() - enqueued)
+            future.set_result(None)
+
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=PRIORITY_INTERACTIVE, tokens=0):
+        """
+        等待调度并占用一个并发槽位。
+
+        参数:
+        priority (str): 请求的优先级类别，PRIORITY_INTERACTIVE、PRIORITY_BACKGROUND 或 PRIORITY_BULK。
+        tokens (int): 估算的请求token数，计入TPM配额。
+
+        异常:
+        SchedulerOverloadedError: 该优先级排队的请求已经达到上限。
+        """
+        if priority not in PRIORITY_RANKS:
+            raise ValueError(f"未知的请求优先级：{priority}")
+        max_depth = self.max_queue_depth.get(priority)
+        if max_depth is not None and self._depths[priority] >= max_depth:
+            self._rejected[priority] += 1
+            raise SchedulerOverloadedError(f"{priority} 优先级的请求队列已满（{max_depth}）")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (PRIORITY_RANKS[priority], next(self._sequence), priority, tokens,
+                                     time.monotonic(), future))
+        self._depths[priority] += 1
+        self._schedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # 还没有被调度，队列中的条目在调度时跳过
+                self._depths[priority] -= 1
+                self._schedule()
+                raise
+            # 调度和取消同时发生时，槽位已经被占用，需要释放
+            self._active -= 1
+            self._schedule()
+            raise
+        try:
+            yield
+        finally:
+            self._active -= 1
+            self._schedule()
+
+    def stats(self):
+        """
+        返回调度的统计信息。
+
+        返回:
+        dict: {"active": 正在进行的请求数, "queued": {优先级: 排队数}, "granted": {优先级: 已调度数},
+               "rejected": {优先级: 被拒绝数}, "wait_p95": {优先级: 最近排队等待时间的p95（秒）}}
+        """
+        wait_p95 = {}
+        for priority, waits in self._waits.items():
+            ordered = sorted(waits)
+            wait_p95[priority] = round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4) if ordered else 0.0
+        return {"active": self._active, "queued": dict(self._depths), "granted": dict(self._granted),
+                "rejected": dict(self._rejected), "wait_p95": wait_p95}
+
+
+class AsyncAPIClient:
+    """
+    AsyncAPIClient 类是所有HTTP接口调用共享的异步客户端层。
+
+    - 每个事件循环共享一个 httpx.AsyncClient，连接保持长连接复用，安装了 h2 时启用 HTTP/2。
+    - 每个接入点有独立的 RequestScheduler：并发上限、RPM/TPM 令牌桶和按优先级排队，以及独立的超时。
+      令牌桶在所有事件循环之间共享。
+    - 网络错误、429 和 5xx 响应按指数退避加随机抖动重试，优先遵循 Retry-After 响应头。
+
+    方法:
+    - request(endpoint, method, url, **kwargs): 发送请求并返回 httpx.Response。
+    - stream(endpoint, method, url, **kwargs): 以流式方式发送请求，作为异步上下文管理器返回 httpx.Response。
+    - stats(): 返回各接入点调度器的排队深度等统计信息。
+    - aclose(): 关闭当前事件循环上的连接池。
+    """
+    def __init__(self, concurrency=None, timeouts=None, max_retries=MAX_RETRIES, rate_limits=None):
+        self.concurrency = dict(ENDPOINT_CONCURRENCY, **(concurrency or {}))
+        self.timeouts = dict(ENDPOINT_TIMEOUTS, **(timeouts or {}))
+        self.rate_limits = dict(ENDPOINT_RATE_LIMITS, **(rate_limits or {}))
+        self.max_retries = max_retries
+        self.http2 = importlib.util.find_spec("h2") is not None
+        # httpx.AsyncClient 和调度器中的 asyncio.Future 都绑定在创建它们的事件循环上，因此按事件循环分别保存
+        self._clients = weakref.WeakKeyDictionary()
+        self._schedulers = weakref.WeakKeyDictionary()
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=httpx.Limits(max_connections=sum(self.concurrency.values()),
+                                    max_keepalive_connections=sum(self.concurrency.values())),
+            )
+            self._clients[loop] = client
+        return client
+
+    def _endpoint_buckets(self, endpoint):
+        """返回接入点的 (RPM令牌桶, TPM令牌桶)，没有配置的限制为 None。"""
+        with self._buckets_lock:
+            if endpoint not in self._buckets:
+                rpm, tpm = self.rate_limits.get(endpoint, (None, None))
+                self._buckets[endpoint] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+            return self._buckets[endpoint]
+
+    def _scheduler(self, endpoint):
+        loop = asyncio.get_running_loop()
+        schedulers = self._schedulers.setdefault(loop, {})
+        if endpoint not in schedulers:
+            schedulers[endpoint] = RequestScheduler(self.concurrency.get(endpoint, 4),
+                                                    *self._endpoint_buckets(endpoint))
+        return schedulers[endpoint]
+
+    def _timeout(self, endpoint):
+        return httpx.Timeout(self.timeouts.get(endpoint, 30.0), connect=CONNECT_TIMEOUT)
+
+    @staticmethod
+    def _backoff(attempt, response=None):
+        """计算第 attempt 次重试前的等待时间。"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), 30.0)
+                except ValueError:
+                    pass
+        return RETRY_BACKOFF_BASE * (2 ** attempt) * (1 + random.random())
+
+    async def request(self, endpoint, method, url, priority=PRIORITY_INTERACTIVE, tokens=0, **kwargs):
+        """
+        按优先级等待接入点的调度，在并发上限和RPM/TPM配额内发送请求，必要时重试。
+
+        参数:
+        endpoint (str): 接入点名称，例如 "chat"、"embedding"。
+        method (str): HTTP方法。
+        url (str): 请求地址。
+        priority (str): 请求的优先级类别。
+        tokens (int): 估算的请求token数，计入接入点的TPM配额。
+        kwargs: 透传给 httpx 的参数（headers、json、params等）。
+
+        返回:
+        httpx.Response: 最后一次请求的响应。重试耗尽后仍然失败时抛出 httpx.RequestError；
+        优先级队列已满时抛出 SchedulerOverloadedError（httpx.RequestError 的子类）。
+        """
+        kwargs.setdefault("timeout", self._timeout(endpoint))
+        client = self._client()
+        async with self._scheduler(endpoint).slot(priority, tokens):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.request(method, url, **kwargs)
+                except httpx.TransportError as e:
+                    if attempt == self.max_retries:
+                        raise
+                    print(f"Request error occurred: {e}，第{attempt + 1}次重试")
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+
+                if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                    print(f"HTTP {response.status_code}，第{attempt + 1}次重试")
+                    await asyncio.sleep(self._backoff(attempt, response))
+                    continue
+                return response
+
+    @contextlib.asynccontextmanager
+    async def stream(self, endpoint, method, url, priority=PRIORITY_INTERACTIVE, tokens=0, **kwargs):
+        """
+        以流式方式发送请求。只在收到响应体之前重试，开始读取响应体之后不再重试。
+
+        参数与request()相同。
+
+        返回:
+        异步上下文管理器，进入时得到响应头已就绪的 httpx.Response，可以用 aiter_lines() 逐行读取。
+        """
+        kwargs.setdefault("timeout", self._timeout(endpoint))
+        client = self._client()
+        async with self._scheduler(endpoint).slot(priority, tokens):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.send(client.build_request(method, url, **kwargs), stream=True)
+                except httpx.TransportError as e:
+                    if attempt == self.max_retries:
+                        raise
+                    print(f"Request error occurred: {e}，第{attempt + 1}次重试")
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+
+                if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                    await response.aclose()
+                    print(f"HTTP {response.status_code}，第{attempt + 1}次重试")
+                    await asyncio.sleep(self._backoff(attempt, response))
+                    continue
+                try:
+                    yield response
+                finally:
+                    await response.aclose()
+                return
+
+    def stats(self):
+        """
+        返回各接入点调度器的统计信息，多个事件循环上的调度器合并计算。
+
+        返回:
+        dict: {接入点: RequestScheduler.stats() 格式的字典}，p95等待时间取各事件循环中的最大值。
+        """
+        merged = {}
+        for schedulers in list(self._schedulers.values()):
+            for endpoint, scheduler in list(schedulers.items()):
+                stats = scheduler.stats()
+                if endpoint not in merged:
+                    merged[endpoint] = stats
+                    continue
+                total = merged[endpoint]
+                total["active"] += stats["active"]
+                for key in ("queued", "granted", "rejected"):
+                    for priority, count in stats[key].items():
+                        total[key][priority] += count
+                for priority, wait in stats["wait_p95"].items():
+                    total["wait_p95"][priority] = max(total["wait_p95"][priority], wait)
+        return merged
+
+    async def aclose(self):
+        """关闭当前事件循环上的连接池。"""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+api_client = AsyncAPIClient()
+
+# 同步包装函数在一个常驻的后台事件循环上运行协程，所有同步调用因此共享同一个连接池和并发上限
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+def _get_background_loop():
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="apis_event_loop", daemon=True)
+            thread.start()
+            _background_loop = loop
+        return _background_loop
+
+def run_sync(coroutine):
+    """
+    在后台事件循环上运行协程并等待结果，供同步代码调用异步接口。
+
+    参数:
+    coroutine: 要运行的协程对象。
+
+    返回:
+    协程的返回值。
+    """
+    loop = _get_background_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        coroutine.close()
+        raise RuntimeError("不能在apis的后台事件循环中调用同步包装函数，请直接await对应的async_函数。")
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+async def async_request_chatgpt(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygpt_api_base,
+                                use_cache=None, priority=PRIORITY_INTERACTIVE):
+    """
+    以异步HTTP客户端的方式调用自定义接入点的GPT模型进行聊天。
 
     参数:
     prompt: 用户的输入消息。
     temperature: 控制回答的随机性。
     api_key: OpenAI提供的API密钥。
     url: API的URL。
+    use_cache: 是否使用LLM回复缓存。为None时只有 temperature <= CACHE_MAX_TEMPERATURE 的调用使用缓存。
+    priority: 请求的优先级类别（PRIORITY_INTERACTIVE、PRIORITY_BACKGROUND 或 PRIORITY_BULK）。
 
     返回:
-    GPT模型的回复消息。异常时返回None。
+    GPT模型的回复消息。异常时（包括优先级队列已满）返回None。
+    """
+    if use_cache is None:
+        use_cache = temperature <= CACHE_MAX_TEMPERATURE
+    if use_cache and response_cache is not None:
+        try:
+            cached = response_cache.get(CHAT_MODEL, prompt, temperature)
+        except Exception as e:
+            print(f"Response cache error: {e}")
+            cached = None
+        if cached is not None:
+            return cached
+
+    message = await _async_request_chatgpt_uncached(prompt, temperature, api_key, url, priority)
+    if message and use_cache and response_cache is not None:
+        try:
+            response_cache.put(CHAT_MODEL, prompt, temperature, message)
+        except Exception as e:
+            print(f"Response cache error: {e}")
+    return message
+
+async def _async_request_chatgpt_uncached(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygpt_api_base,
+                                          priority=PRIORITY_INTERACTIVE):
+    """
+    调用自定义接入点的GPT模型进行聊天，不经过缓存。参数和返回值与async_request_chatgpt相同。
     """
 
     headers = {
@@ -37,15 +502,18 @@ def request_chatgpt(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygp
     }
 
     data = {
-        "model": "gpt-3.5-turbo",
+        "model": CHAT_MODEL,
         "messages": [
             {"role": "user", "content": prompt}
         ],
         "temperature": temperature
     }
 
+    response = None
     try:
-        response = requests.post(url=url, headers=headers, json=data)
+        response = await api_client.request("chat", "POST", url, priority=priority,
+                                            tokens=estimate_tokens(prompt) + CHAT_COMPLETION_TOKENS,
+                                            headers=headers, json=data)
         response.raise_for_status()  # 将触发HTTP错误状态码的异常
 
         # 检查API是否返回了预期的JSON结构
@@ -60,11 +528,11 @@ def request_chatgpt(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygp
         else:
             raise ValueError("Response JSON does not contain 'choices' or is empty.")
 
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         print(f"HTTP error occurred: {http_err}")
         print(f"Response body: {response.text}")
         return None
-    except requests.exceptions.RequestException as req_err:
+    except httpx.RequestError as req_err:
         print(f"Request error occurred: {req_err}")
         return None
     except ValueError as val_err:
@@ -74,32 +542,210 @@ def request_chatgpt(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygp
         print(f"An unexpected error occurred: {e}")
         return None
 
-def request_embedding(things:list or str, api_key=openai.api_key, url=openai_api_base):
+def request_chatgpt(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygpt_api_base, use_cache=None,
+                    priority=PRIORITY_INTERACTIVE):
+    """
+    async_request_chatgpt的同步版本，参数和返回值相同。
+    """
+    return run_sync(async_request_chatgpt(prompt, temperature, api_key, url, use_cache, priority))
+
+async def async_stream_chatgpt(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygpt_api_base,
+                               priority=PRIORITY_INTERACTIVE):
     """
-    以requests库的方式调用自定义接入点的text-embedding-ada-002模型获取输入词语的embedding。
+    以流式（SSE，stream: true）方式调用自定义接入点的GPT模型，逐段产出回复内容。
 
     参数:
-    things: 需要获取embedding的词语，可以是一个词语的字符串或者是多个词语的列表。
+    prompt: 用户的输入消息。
+    temperature: 控制回答的随机性。
+    api_key: OpenAI提供的API密钥。
+    url: API的URL。
+    priority: 请求的优先级类别。
 
     返回:
-    输入词语的embedding列表。异常时返回None。
+    异步生成器，逐个产出回复的增量文本。异常时打印错误并提前结束。
     """
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {api_key}',
     }
 
+    data = {
+        "model": CHAT_MODEL,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": temperature,
+        "stream": True
+    }
+
+    try:
+        async with api_client.stream("chat", "POST", url, priority=priority,
+                                     tokens=estimate_tokens(prompt) + CHAT_COMPLETION_TOKENS,
+                                     headers=headers, json=data) as response:
+            if response.is_error:
+                body = await response.aread()
+                print(f"HTTP error occurred: {response.status_code}")
+                print(f"Response body: {body.decode('utf-8', errors='replace')}")
+                return
+
+            async for line in response.aiter_lines():
+                # SSE的每个事件以 "data: " 开头，以 "data: [DONE]" 结束
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                chunk = json.loads(payload)
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+    except httpx.RequestError as req_err:
+        print(f"Request error occurred: {req_err}")
+    except ValueError as val_err:
+        print(f"Value error: {val_err}")
+
+def stream_chatgpt(prompt, temperature=0.8, api_key=easygpt_api_key, url=easygpt_api_base,
+                   priority=PRIORITY_INTERACTIVE):
+    """
+    async_stream_chatgpt的同步版本：在后台事件循环上读取流，以普通生成器的方式逐段产出回复内容。
+    """
+    loop = _get_background_loop()
+    stream = async_stream_chatgpt(prompt, temperature, api_key, url, priority)
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(stream.__anext__(), loop).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        # 调用者提前停止迭代时关闭底层连接
+        asyncio.run_coroutine_threadsafe(stream.aclose(), loop).result()
+
+async def async_request_embedding(things:list or str, api_key=openai.api_key, url=openai_api_base, use_cache=True,
+                                  priority=PRIORITY_INTERACTIVE):
+    """
+    获取输入词语的embedding。先查询本地的嵌入向量缓存，只把未命中的词语一次性发送给接口，并把结果写回缓存。
+    缓存未命中的单条词语（字符串输入）由 embedding_batcher 与同一时间窗口内的其他请求合并为一次接口调用。
+
+    参数:
+    things: 需要获取embedding的词语，可以是一个词语的字符串或者是多个词语的列表。
+    use_cache: 是否使用嵌入向量缓存。
+    priority: 请求的优先级类别。合并发送的批次采用其中最高的优先级。
+
+    返回:
+    输入词语的embedding列表，顺序与输入一致。异常时返回None。
+    """
+    # 使用默认接入点的单条文本在缓存未命中时交给批处理器，与其他会话同时发起的请求合并发送
+    if (isinstance(things, str) and use_cache and embedding_batcher is not None
+            and api_key == openai.api_key and url == openai_api_base):
+        embedding = _cached_embedding(things)
+        if embedding is None:
+            embedding = await embedding_batcher.async_embed(things, PRIORITY_RANKS[priority])
+        return [embedding] if embedding is not None else None
+
     # 确保输入是列表格式
     if isinstance(things, str):
         things = [things]
 
+    if not use_cache or embedding_cache is None:
+        return await _async_request_embedding_uncached(things, api_key, url, priority)
+
+    try:
+        cached = embedding_cache.get_many(EMBEDDING_MODEL, things)
+    except Exception as e:
+        print(f"Embedding cache error: {e}")
+        return await _async_request_embedding_uncached(things, api_key, url, priority)
+
+    # 去重后只请求未命中的词语
+    missing = list(dict.fromkeys(thing for thing in things if thing not in cached))
+    if missing:
+        embeddings = await _async_request_embedding_uncached(missing, api_key, url, priority)
+        if embeddings is None:
+            return None
+        try:
+            embedding_cache.put_many(EMBEDDING_MODEL, missing, embeddings)
+        except Exception as e:
+            print(f"Embedding cache error: {e}")
+        cached.update(zip(missing, embeddings))
+
+    return [cached[thing] for thing in things]
+
+def request_embedding(things:list or str, api_key=openai.api_key, url=openai_api_base, use_cache=True,
+                      priority=PRIORITY_INTERACTIVE):
+    """
+    async_request_embedding的同步版本，参数和返回值相同。
+    """
+    return run_sync(async_request_embedding(things, api_key, url, use_cache, priority))
+
+def _cached_embedding(text):
+    """查询单条文本的缓存向量，未命中或缓存不可用时返回None。"""
+    if embedding_cache is None:
+        return None
+    try:
+        return embedding_cache.get_many(EMBEDDING_MODEL, [text]).get(text)
+    except Exception as e:
+        print(f"Embedding cache error: {e}")
+        return None
+
+_PRIORITIES_BY_RANK = {rank: priority for priority, rank in PRIORITY_RANKS.items()}
+
+def _request_embedding_batch(texts, rank):
+    """
+    批处理器的请求函数：提交的文本在入队前已经查询过缓存，这里直接请求接口并把结果写回缓存，不再重复查询。
+    """
+    embeddings = run_sync(_async_request_embedding_uncached(texts, priority=_PRIORITIES_BY_RANK[rank]))
+    if embeddings is not None and embedding_cache is not None:
+        try:
+            embedding_cache.put_many(EMBEDDING_MODEL, texts, embeddings)
+        except Exception as e:
+            print(f"Embedding cache error: {e}")
+    return embeddings
+
+embedding_batcher = (EmbeddingBatcher(_request_embedding_batch, EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_MAX_WAIT)
+                     if EMBEDDING_BATCH_MAX_WAIT > 0 else None)
+
+async def _async_request_embedding_uncached(things, api_key=openai.api_key, url=openai_api_base,
+                                            priority=PRIORITY_INTERACTIVE):
+    """
+    调用自定义接入点的text-embedding-ada-002模型获取输入词语的embedding，不经过缓存。
+    超过 EMBEDDING_REQUEST_MAX_ITEMS 条的词语分批依次请求。
+
+    参数:
+    things: 需要获取embedding的词语列表。
+    priority: 请求的优先级类别。
+
+    返回:
+    输入词语的embedding列表。任何一批异常时返回None。
+    """
+    if len(things) > EMBEDDING_REQUEST_MAX_ITEMS:
+        embeddings = []
+        for start in range(0, len(things), EMBEDDING_REQUEST_MAX_ITEMS):
+            chunk = await _async_request_embedding_uncached(things[start:start + EMBEDDING_REQUEST_MAX_ITEMS],
+                                                            api_key, url, priority)
+            if chunk is None:
+                return None
+            embeddings.extend(chunk)
+        return embeddings
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {api_key}',
+    }
+
     data = {
         'input': things,  # 需要获取embedding的词语
-        'model': "text-embedding-ada-002",  # 使用text-embedding-ada-002模型
+        'model': EMBEDDING_MODEL,  # 使用text-embedding-ada-002模型
     }
 
+    response = None
     try:
-        response = requests.post(url=url, headers=headers, json=data)
+        response = await api_client.request("embedding", "POST", url, priority=priority,
+                                            tokens=sum(estimate_tokens(thing) for thing in things),
+                                            headers=headers, json=data)
         response.raise_for_status()  # 将触发HTTP错误状态码的异常
 
         # 检查API是否返回了预期的JSON结构
@@ -110,11 +756,11 @@ def request_embedding(things:list or str, api_key=openai.api_key, url=openai_api
         else:
             raise ValueError("Response JSON does not contain 'data'.")
 
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         print(f"HTTP error occurred: {http_err}")
         print(f"Response body: {response.text}")
         return None
-    except requests.exceptions.RequestException as req_err:
+    except httpx.RequestError as req_err:
         print(f"Request error occurred: {req_err}")
         return None
     except ValueError as val_err:
@@ -235,7 +881,7 @@ def genshin_tts_v2(prompt, speaker):
         print(f"An error occurred: {e}")
         return None
 
-def genshin_tts(text:str, speaker:str):
+async def async_genshin_tts(text:str, speaker:str):
     """
     使用原神tts-api获取音频wav文件
 
@@ -246,7 +892,6 @@ def genshin_tts(text:str, speaker:str):
     返回:
     音频文件的地址。异常时返回None。
     """
-    url = "https://tts.ai-lab.top"
     data = {
         "token": tts_api_key,
         "speaker": speaker,
@@ -257,7 +902,7 @@ def genshin_tts(text:str, speaker:str):
         "length": 1.0
     }
     try:
-        response = requests.post(url, json=data, timeout=10)
+        response = await api_client.request("tts", "POST", tts_api_base, json=data)
         if response.status_code == 200:
             response_data = response.json()
             print("Audio URL: ", response_data["audio"])
@@ -274,7 +919,7 @@ def genshin_tts(text:str, speaker:str):
             audio_file_path = os.path.join(audio_folder, audio_file_name)
 
             # get音频文件
-            response = requests.get(audio_url)
+            response = await api_client.request("tts", "GET", audio_url)
             with open(audio_file_path, 'wb') as f:
                 f.write(response.content)
 
@@ -283,14 +928,20 @@ def genshin_tts(text:str, speaker:str):
         else:
             print("Error: ", response.status_code)
             return None
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         print("Timeout occurred")
         return None
     except Exception as e:
         print(f"An error occurred: {e}")
         return None
 
-def bing_search(query: str, mkt: str = "zh-CN"):
+def genshin_tts(text:str, speaker:str):
+    """
+    async_genshin_tts的同步版本，参数和返回值相同。
+    """
+    return run_sync(async_genshin_tts(text, speaker))
+
+async def async_bing_search(query: str, mkt: str = "zh-CN"):
     """
     使用Bing搜索API搜索指定的查询字符串，并返回搜索结果的网页信息。
 
@@ -302,7 +953,6 @@ def bing_search(query: str, mkt: str = "zh-CN"):
     search_results: 搜索结果的网页信息list，元素为url和概述的字典。异常时返回None。
     """
     try:
-        url = "https://api.bing.microsoft.com/v7.0/search"
         headers = {
             "Ocp-Apim-Subscription-Key": bing_api_key
         }
@@ -312,7 +962,7 @@ def bing_search(query: str, mkt: str = "zh-CN"):
             "mkt": mkt
         }
 
-        response = requests.get(url, headers=headers, params=params)
+        response = await api_client.request("bing", "GET", bing_api_base, headers=headers, params=params)
         response = response.json()
         # 将搜索结果保存到一个临时JSON文件中
         with open("../resource/bing_temp.json", 'w', encoding='utf-8') as f:
@@ -344,6 +994,12 @@ def bing_search(query: str, mkt: str = "zh-CN"):
         print(f"An error occurred: {e}")
         return None
 
+def bing_search(query: str, mkt: str = "zh-CN"):
+    """
+    async_bing_search的同步版本，参数和返回值相同。
+    """
+    return run_sync(async_bing_search(query, mkt))
+
 if __name__ == "__main__":
     print(embedding("nihao"))
     genshin_tts_v2("你好","胡桃")
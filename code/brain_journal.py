@@ -0,0 +1,314 @@
+import os
+import json
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import brain_snapshot
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# 距离上次快照累计多少条日志记录后，在后台把日志压缩进快照
+JOURNAL_COMPACT_EVERY = 200
+
+# 日志记录的操作类型
+ADD_MEMORY = "add_memory"
+DEL_MEMORY = "del_memory"
+CLEAR_MEMORY = "clear_memory"
+ADD_KNOWLEDGE = "add_knowledge"
+DEL_KNOWLEDGE = "del_knowledge"
+CLEAR_KNOWLEDGE = "clear_knowledge"
+
+
+def _encode_item(item):
+    """把记忆/知识字典中的嵌入向量编码为 float64 的 base64 字符串，比JSON浮点数更短且读出后完全一致。"""
+    item = dict(item)
+    embedding = item.pop("embedding", None)
+    if embedding is not None:
+        item["embedding_b64"] = base64.b64encode(np.asarray(embedding, dtype=np.float64).tobytes()).decode("ascii")
+    return item
+
+
+def _decode_item(item):
+    """_encode_item 的逆操作。"""
+    item = dict(item)
+    encoded = item.pop("embedding_b64", None)
+    if encoded is not None:
+        item["embedding"] = np.frombuffer(base64.b64decode(encoded), dtype=np.float64).tolist()
+    return item
+
+
+def _write_json_atomic(file_path, data):
+    """写临时文件并 fsync 后原子替换，写到一半崩溃也不会损坏原文件。"""
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'w', encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False, indent=4, default=brain_snapshot.materialize)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+def read_snapshot_file(file_path):
+    """读取快照文件，根据文件头自动识别二进制快照或JSON。"""
+    if brain_snapshot.is_snapshot(file_path):
+        return brain_snapshot.read_snapshot(file_path)
+    with open(file_path, 'r', encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_snapshot_file(file_path, data):
+    """写入快照文件，扩展名为 .brain 时使用二进制格式，否则使用JSON。"""
+    if file_path.endswith(brain_snapshot.SNAPSHOT_SUFFIX):
+        brain_snapshot.write_snapshot(file_path, data)
+    else:
+        _write_json_atomic(file_path, data)
+
+
+def read_records(journal_path):
+    """
+    读取日志文件中的所有记录。
+
+    返回:
+    list: 按写入顺序排列的记录列表。崩溃时写了一半的末尾记录会被忽略。
+    """
+    records = []
+    if not os.path.exists(journal_path):
+        return records
+    with open(journal_path, 'r', encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"日志 {journal_path} 中有一条记录不完整，已忽略")
+                break
+    return records
+
+
+def apply_record(json_data, record):
+    """把一条日志记录应用到 Brain.to_json() 格式的字典上。"""
+    op = record["op"]
+    memory_stream = json_data["memory_stream"]
+    basic_knowledge = json_data["basic_knowledge"]
+    if op == ADD_MEMORY:
+        memory_stream.append(_decode_item(record["item"]))
+    elif op == DEL_MEMORY:
+        del memory_stream[record["index"]]
+    elif op == CLEAR_MEMORY:
+        memory_stream.clear()
+    elif op == ADD_KNOWLEDGE:
+        basic_knowledge.append(_decode_item(record["item"]))
+    elif op == DEL_KNOWLEDGE:
+        del basic_knowledge[record["index"]]
+    elif op == CLEAR_KNOWLEDGE:
+        basic_knowledge.clear()
+    else:
+        raise ValueError(f"未知的日志操作：{op}")
+
+
+class JournalInUseError(RuntimeError):
+    """另一个进程已经持有同一份快照和日志的锁。"""
+
+
+class BrainJournal:
+    """
+    BrainJournal 类是 Brain 的预写日志：每次记忆/知识的增删都以一行JSON追加到日志文件并 fsync，
+    不再每回合重写整个角色文件。
+
+    角色文件（快照）中记录了它所包含的最后一条日志的序号 journal_seq。加载时先读快照，再按顺序重放
+    序号更大的日志记录。日志累计到一定条数后，在后台线程把当前状态写成新快照，并丢弃已被快照包含的记录。
+
+    方法:
+    - for_brain(name, directory, binary): 使用 {directory}/{name}.json（binary 为 True 时为二进制快照
+      {name}.brain）和 {directory}/{name}.journal.jsonl 创建日志。
+    - acquire(): 独占地锁定日志，另一个进程已经在使用时抛出 JournalInUseError。
+    - transaction(): 返回一个锁，Brain 在修改状态并写日志时持有它，保证快照与序号一致。
+    - append(op, **fields): 追加并 fsync 一条记录。
+    - replay(json_data): 把快照之后的记录应用到快照数据上。
+    - load_json(): 读取快照并重放日志，返回可以传给 Brain.from_json 的字典。
+    - reset(brain): 以 brain 的当前状态写入新快照并清空日志。
+    - compact(brain): 把日志压缩进快照。
+    - maybe_compact(brain): 记录足够多时在后台执行 compact。
+    """
+    def __init__(self, snapshot_path, journal_path, compact_every=JOURNAL_COMPACT_EVERY):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._file = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal_compact")
+        self._compacting = False
+        self.lock_path = f"{journal_path}.lock"
+        self._lock_file = None
+
+        self.snapshot_seq = self._read_snapshot_seq()
+        records = read_records(journal_path)
+        self.seq = max([self.snapshot_seq] + [record["seq"] for record in records])
+
+    @classmethod
+    def for_brain(cls, name, directory="../resource", binary=False):
+        suffix = brain_snapshot.SNAPSHOT_SUFFIX if binary else ".json"
+        return cls(os.path.join(directory, f"{name}{suffix}"),
+                   os.path.join(directory, f"{name}.journal.jsonl"))
+
+    def _read_snapshot_seq(self):
+        try:
+            if brain_snapshot.is_snapshot(self.snapshot_path):
+                return brain_snapshot.read_header(self.snapshot_path).get("journal_seq", 0)
+            with open(self.snapshot_path, 'r', encoding="utf-8") as file:
+                return json.load(file).get("journal_seq", 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.journal_path, 'a', encoding="utf-8")
+        return self._file
+
+    def acquire(self):
+        """
+        独占地锁定日志（{journal_path}.lock）。同一份快照和日志只能由一个进程写入：两个进程各自从快照恢复后
+        交替追加、压缩或重置，会互相破坏持久化的状态，所以 web_demo 和 api_server 加载大脑（Brain.load_persisted）
+        之前都要先获取这个锁。锁由操作系统在 close() 或进程退出（包括崩溃）时释放，不会残留。
+
+        异常:
+        JournalInUseError: 另一个进程已经持有锁。
+        """
+        if self._lock_file is not None:
+            return
+        lock_file = open(self.lock_path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            raise JournalInUseError(f"日志 {self.journal_path} 正在被另一个进程使用（{self.lock_path}），"
+                                    f"请先停止该进程") from None
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self._lock_file = lock_file
+
+    def transaction(self):
+        return self._lock
+
+    def append(self, op, **fields):
+        """
+        追加一条日志记录，写入后立即 fsync。
+
+        参数:
+        op (str): 操作类型。
+        fields: 操作参数，记忆/知识字典放在 item 中，其嵌入向量会被编码。
+
+        返回:
+        int: 该记录的序号。
+        """
+        if "item" in fields:
+            fields["item"] = _encode_item(fields["item"])
+        with self._lock:
+            self.seq += 1
+            record = {"seq": self.seq, "op": op, **fields}
+            file = self._open()
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+            return self.seq
+
+    def replay(self, json_data):
+        """
+        把快照之后的日志记录按顺序应用到快照数据上。
+
+        参数:
+        json_data (dict): 快照数据，其中的 journal_seq 会被移除。
+
+        返回:
+        dict: 应用日志后的数据，可以直接传给 Brain 的构造函数。
+        """
+        snapshot_seq = json_data.pop("journal_seq", 0)
+        applied = 0
+        for record in read_records(self.journal_path):
+            if record["seq"] > snapshot_seq:
+                apply_record(json_data, record)
+                applied += 1
+        if applied:
+            print(f"从日志 {self.journal_path} 重放了 {applied} 条记录")
+        return json_data
+
+    def load_json(self):
+        """读取快照并重放日志。"""
+        return self.replay(read_snapshot_file(self.snapshot_path))
+
+    def _snapshot(self, brain):
+        """在锁内拷贝 brain 的状态和当前序号，之后的序列化不阻塞新的修改。"""
+        with self._lock:
+            data = brain.to_json()
+            data["basic_knowledge"] = list(data["basic_knowledge"])
+            data["memory_stream"] = list(data["memory_stream"])
+            data["journal_seq"] = self.seq
+        return data
+
+    def _rewrite_journal(self, keep_after_seq):
+        """只保留序号大于 keep_after_seq 的记录，原子替换日志文件。"""
+        with self._lock:
+            records = [record for record in read_records(self.journal_path) if record["seq"] > keep_after_seq]
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            temp_path = f"{self.journal_path}.tmp"
+            with open(temp_path, 'w', encoding="utf-8") as file:
+                for record in records:
+                    file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.journal_path)
+            self.snapshot_seq = keep_after_seq
+
+    def reset(self, brain):
+        """以 brain 的当前状态写入新快照，并清空日志。"""
+        data = self._snapshot(brain)
+        write_snapshot_file(self.snapshot_path, data)
+        self._rewrite_journal(data["journal_seq"])
+
+    def compact(self, brain):
+        """
+        把日志压缩进快照：先原子地写入包含当前序号的快照，再丢弃已被快照包含的日志记录。
+        两步之间崩溃时，重放会跳过快照已包含的记录，结果仍然正确。
+        """
+        try:
+            data = self._snapshot(brain)
+            write_snapshot_file(self.snapshot_path, data)
+            self._rewrite_journal(data["journal_seq"])
+        except (IOError, OSError) as e:
+            print(f"压缩日志时发生错误：{e}")
+        finally:
+            self._compacting = False
+
+    def maybe_compact(self, brain):
+        """距离上次快照的记录数达到 compact_every 时，在后台线程执行 compact。"""
+        with self._lock:
+            if self._compacting or self.seq - self.snapshot_seq < self.compact_every:
+                return None
+            self._compacting = True
+        return self._executor.submit(self.compact, brain)
+
+    def close(self):
+        """等待后台压缩完成，关闭日志文件并释放日志锁。"""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lock_file is not None:
+                # 关闭文件即释放锁
+                self._lock_file.close()
+                self._lock_file = None
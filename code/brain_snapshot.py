@@ -0,0 +1,262 @@
+import os
+import json
+import struct
+import argparse
+import numpy as np
+
+# 二进制快照的文件格式：
+#   MAGIC(8字节) | 版本(uint32) | 头长度(uint64) | UTF-8 JSON头 | 填充 | 嵌入块1 | 填充 | 嵌入块2 ...
+# JSON头保存除嵌入向量以外的所有字段；basic_knowledge 和 memory_stream 的嵌入向量各自保存为一个
+# 连续的行主序矩阵，条目中的 embedding_row 指向矩阵的行。每个块按 BLOCK_ALIGNMENT 对齐，可以直接内存映射。
+SNAPSHOT_MAGIC = b"LUCYBRN\x00"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = ".brain"
+BLOCK_ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<8sIQ")
+
+SNAPSHOT_DTYPES = ("float64", "float32", "float16")
+# 保存为 float32 时允许的最大绝对误差。接口返回的嵌入向量是十进制 JSON 数字，几乎不能精确地用 float32 表示，
+# 但分量的量级约为 1e-2，float32 的舍入误差远小于该值，与 VectorIndex 用 float32 检索的精度一致
+FLOAT32_TOLERANCE = 1e-7
+EMBEDDING_FIELDS = ("basic_knowledge", "memory_stream")
+
+
+class LazyEmbedding:
+    """
+    LazyEmbedding 类是内存映射嵌入块中某一行的惰性引用，在需要之前不把向量解码为 Python 浮点数列表。
+
+    它可以像列表一样取长度、迭代、下标访问和比较，也可以直接传给 np.asarray；tolist() 返回与
+    JSON 格式完全相同的浮点数列表。它引用快照文件的内存映射，快照文件被替换后仍然读取旧文件的内容。
+    """
+    __slots__ = ("block", "row")
+
+    def __init__(self, block, row):
+        self.block = block
+        self.row = row
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.block[self.row], dtype=dtype or np.float64)
+
+    def __len__(self):
+        return self.block.shape[1]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, index):
+        return self.tolist()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, LazyEmbedding):
+            other = other.tolist()
+        return self.tolist() == other
+
+    def __repr__(self):
+        return f"LazyEmbedding(row={self.row}, dim={len(self)})"
+
+    def tolist(self):
+        return self.block[self.row].astype(np.float64).tolist()
+
+
+def stack_embeddings(embeddings):
+    """
+    把嵌入向量列表整理为可以直接交给 VectorIndex 的形式。
+
+    如果所有向量都是同一个内存映射块中的惰性行，直接用一次花式索引从块中取出矩阵，
+    不经过 Python 浮点数列表；否则原样返回列表。
+    """
+    if embeddings and all(isinstance(e, LazyEmbedding) for e in embeddings):
+        block = embeddings[0].block
+        if all(e.block is block for e in embeddings):
+            return np.asarray(block[[e.row for e in embeddings]])
+    return embeddings
+
+
+def materialize(value):
+    """json.dump 的 default 回调：把惰性嵌入向量转换为浮点数列表。"""
+    if isinstance(value, LazyEmbedding):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _pad(offset):
+    return (-offset) % BLOCK_ALIGNMENT
+
+
+def _split_embeddings(items, dtype):
+    """
+    把条目列表拆成（不含嵌入向量的条目, 嵌入矩阵）。
+
+    维度与多数条目一致的嵌入向量进入矩阵，条目中记录 embedding_row；空向量或维度不一致的向量原样留在条目中。
+    选择 float32 时，如果某个分量转换后的误差超过 FLOAT32_TOLERANCE（例如量级异常大的向量），整个块改用 float64。
+    需要逐位无损往返时应显式选择 float64。
+    """
+    dims = [len(item["embedding"]) for item in items if item.get("embedding")]
+    dim = max(set(dims), key=dims.count) if dims else 0
+
+    rows, stripped = [], []
+    for item in items:
+        item = dict(item)
+        embedding = item.get("embedding")
+        if dim and embedding is not None and len(embedding) == dim:
+            del item["embedding"]
+            item["embedding_row"] = len(rows)
+            rows.append(embedding)
+        stripped.append(item)
+
+    matrix = np.asarray(stack_embeddings(rows), dtype=np.float64).reshape(len(rows), dim)
+    if dtype == "float32" and not np.allclose(matrix.astype(np.float32), matrix, rtol=0, atol=FLOAT32_TOLERANCE):
+        print(f"嵌入向量保存为float32的误差超过{FLOAT32_TOLERANCE}，该块改用float64保存")
+        dtype = "float64"
+    return stripped, matrix.astype(dtype)
+
+
+def write_snapshot(file_path, json_data, dtype="float32"):
+    """
+    把 Brain.to_json() 格式的数据写成二进制快照。先写临时文件再原子替换。
+
+    参数:
+    file_path (str): 快照文件路径。
+    json_data (dict): Brain.to_json() 格式的数据，可以带有 journal_seq。
+    dtype (str): 嵌入块的数据类型。float32 的误差不超过 FLOAT32_TOLERANCE（超过时自动改用 float64），
+                 float64 逐位无损，float16 有损但体积再减半。
+    """
+    if dtype not in SNAPSHOT_DTYPES:
+        raise ValueError(f"不支持的快照数据类型：{dtype}，可选：{SNAPSHOT_DTYPES}")
+
+    header = {key: value for key, value in json_data.items() if key not in EMBEDDING_FIELDS}
+    blocks = []
+    header["blocks"] = {}
+    for field in EMBEDDING_FIELDS:
+        items, matrix = _split_embeddings(json_data.get(field, []), dtype)
+        header[field] = items
+        header["blocks"][field] = {"dtype": matrix.dtype.name, "shape": list(matrix.shape)}
+        blocks.append((field, matrix))
+
+    # 块的偏移依赖头的长度，而头里又记录偏移：先用占位偏移计算一次头长度，偏移写入后再按需重算
+    offsets_stable = False
+    header_bytes = b""
+    while not offsets_stable:
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        offset = _PREAMBLE.size + len(header_bytes)
+        offsets_stable = True
+        for field, matrix in blocks:
+            offset += _pad(offset)
+            if header["blocks"][field].get("offset") != offset:
+                header["blocks"][field]["offset"] = offset
+                offsets_stable = False
+            offset += matrix.nbytes
+
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header_bytes)))
+        file.write(header_bytes)
+        for field, matrix in blocks:
+            file.write(b"\0" * (header["blocks"][field]["offset"] - file.tell()))
+            file.write(np.ascontiguousarray(matrix).tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+def is_snapshot(file_path):
+    """判断文件是否为二进制快照。"""
+    try:
+        with open(file_path, "rb") as file:
+            return file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+    except OSError:
+        return False
+
+
+def read_header(file_path):
+    """读取二进制快照的JSON头。"""
+    with open(file_path, "rb") as file:
+        magic, version, header_size = _PREAMBLE.unpack(file.read(_PREAMBLE.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{file_path} 不是二进制Brain快照")
+        if version > SNAPSHOT_VERSION:
+            raise ValueError(f"{file_path} 的快照版本 {version} 高于当前支持的版本 {SNAPSHOT_VERSION}")
+        return json.loads(file.read(header_size).decode("utf-8"))
+
+
+def read_block(file_path, block, mmap=False):
+    """
+    读取一个嵌入块。
+
+    参数:
+    block (dict): 头中记录的块信息（dtype、shape、offset）。
+    mmap (bool): 为 True 时返回只读的内存映射数组，不把数据读入内存。
+    """
+    dtype = np.dtype(block["dtype"])
+    shape = tuple(block["shape"])
+    if not shape[0]:
+        return np.empty(shape, dtype=dtype)
+    if mmap:
+        return np.memmap(file_path, dtype=dtype, mode="r", offset=block["offset"], shape=shape)
+    with open(file_path, "rb") as file:
+        file.seek(block["offset"])
+        return np.fromfile(file, dtype=dtype, count=shape[0] * shape[1]).reshape(shape)
+
+
+def read_snapshot(file_path, lazy=False):
+    """
+    读取二进制快照，还原为 Brain.to_json() 格式的数据。
+
+    参数:
+    file_path (str): 快照文件路径。
+    lazy (bool): 为 False 时嵌入向量还原为浮点数列表；为 True 时嵌入块以内存映射方式打开，
+                 每个嵌入向量是一个 LazyEmbedding，文本和元数据仍然立即加载。
+
+    返回:
+    dict: 可以直接传给 Brain.from_json 的数据。
+    """
+    header = read_header(file_path)
+    blocks = header.pop("blocks")
+    json_data = dict(header)
+    for field in EMBEDDING_FIELDS:
+        if lazy:
+            matrix = read_block(file_path, blocks[field], mmap=True)
+        else:
+            matrix = read_block(file_path, blocks[field]).astype(np.float64)
+        items = []
+        for item in header.get(field, []):
+            item = dict(item)
+            row = item.pop("embedding_row", None)
+            if row is not None:
+                item["embedding"] = LazyEmbedding(matrix, row) if lazy else matrix[row].tolist()
+            items.append(item)
+        json_data[field] = items
+    return json_data
+
+
+def json_to_snapshot(json_path, snapshot_path, dtype="float32"):
+    """把JSON格式的角色文件转换为二进制快照。"""
+    with open(json_path, "r", encoding="utf-8") as file:
+        write_snapshot(snapshot_path, json.load(file), dtype)
+
+
+def snapshot_to_json(snapshot_path, json_path):
+    """把二进制快照转换回JSON格式的角色文件。"""
+    with open(json_path, "w", encoding="utf-8") as file:
+        json.dump(read_snapshot(snapshot_path), file, indent=4, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    # python brain_snapshot.py to-binary ../resource/hutao.json ../resource/hutao.brain [--dtype float32]
+    # python brain_snapshot.py to-json ../resource/hutao.brain ../resource/hutao.json
+    parser = argparse.ArgumentParser(description="在JSON角色文件和二进制Brain快照之间转换")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    to_binary = subparsers.add_parser("to-binary", help="JSON -> 二进制快照")
+    to_binary.add_argument("source")
+    to_binary.add_argument("target")
+    to_binary.add_argument("--dtype", choices=SNAPSHOT_DTYPES, default="float32")
+    to_json = subparsers.add_parser("to-json", help="二进制快照 -> JSON")
+    to_json.add_argument("source")
+    to_json.add_argument("target")
+    args = parser.parse_args()
+
+    if args.command == "to-binary":
+        json_to_snapshot(args.source, args.target, args.dtype)
+    else:
+        snapshot_to_json(args.source, args.target)
+    print(f"转换了 {args.source}：{os.path.getsize(args.source)} 字节 -> {args.target}：{os.path.getsize(args.target)} 字节")
@@ -0,0 +1,214 @@
+import re
+import logging
+import threading
+import apis
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 提示词中对话上下文（滚动总结 + 最近的原文对话）的token预算
+CONTEXT_TOKEN_BUDGET = 800
+# 最多保留的原文对话轮数
+MAX_RECENT_TURNS = 6
+# 滚动总结的token上限
+SUMMARY_TOKEN_LIMIT = 200
+# tiktoken 使用的编码，与 gpt-3.5-turbo 一致
+TOKEN_ENCODING = "cl100k_base"
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def _get_encoding():
+    """加载 tiktoken 编码；未安装或加载失败（例如无法下载编码文件）时返回 None。"""
+    global _encoding, tiktoken
+    if tiktoken is None:
+        return None
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+            except Exception as e:
+                print(f"无法加载tiktoken编码，改用估算的token数：{e}")
+                tiktoken = None
+    return _encoding
+
+
+def count_tokens(text):
+    """
+    在本地计算文本的token数。安装了 tiktoken 时精确计算，否则估算：每个中日韩字符算一个token，
+    其余字符每4个算一个token。
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_tokens(text, max_tokens, keep_end=False):
+    """
+    把文本截断到不超过 max_tokens 个token。
+
+    参数:
+    keep_end (bool): 为 False 时保留开头，为 True 时保留结尾（例如对话中最新的部分）。
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        return encoding.decode(tokens[-max_tokens:] if keep_end else tokens[:max_tokens])
+
+    def piece(length):
+        return text[len(text) - length:] if keep_end else text[:length]
+
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(piece(middle)) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return piece(low)
+
+
+class ConversationContext:
+    """
+    ConversationContext 类为提示词生成有token预算的对话上下文。
+
+    最近的若干轮对话原文保留；更早的对话被分批折叠进一个滚动总结，每次折叠只把新移出窗口的对话
+    和旧的总结一起交给LLM，总结本身也有token上限。因此无论会话多长，提示词中对话上下文的大小都不超过预算。
+
+    对话历史可以是 Gradio 的 [[用户输入, 回复], ...] 列表（当前轮的回复为 None），也可以是字符串列表。
+
+    方法:
+    - render(conversation_history): 返回放进提示词的对话上下文文本。
+    - reset(): 清空滚动总结（开始新的会话）。
+    - to_json() / load_json(data): 导出/恢复滚动总结的状态，用于会话的持久化。
+    """
+    def __init__(self, character_name, user_name="hadi", token_budget=CONTEXT_TOKEN_BUDGET,
+                 max_recent_turns=MAX_RECENT_TURNS, summary_token_limit=SUMMARY_TOKEN_LIMIT):
+        self.character_name = character_name
+        self.user_name = user_name
+        self.token_budget = token_budget
+        self.max_recent_turns = max_recent_turns
+        self.summary_token_limit = summary_token_limit
+        self.summary = ""
+        # 已经折叠进滚动总结的对话轮数（从会话开头算起）
+        self._folded_turns = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """清空滚动总结，开始新的会话。"""
+        with self._lock:
+            self.summary = ""
+            self._folded_turns = 0
+
+    def to_json(self):
+        """导出滚动总结的状态。"""
+        with self._lock:
+            return {"summary": self.summary, "folded_turns": self._folded_turns}
+
+    def load_json(self, data):
+        """恢复 to_json() 导出的状态。"""
+        with self._lock:
+            self.summary = data.get("summary", "")
+            self._folded_turns = data.get("folded_turns", 0)
+
+    def _format_turn(self, turn):
+        """把一轮对话格式化为纯文本，去掉列表语法和尚未生成的回复。"""
+        if isinstance(turn, str):
+            return turn
+        query, response = (list(turn) + [None, None])[:2]
+        lines = []
+        if query:
+            lines.append(f"{self.user_name}：{query}")
+        if response:
+            lines.append(f"{self.character_name}：{response}")
+        return "\n".join(lines)
+
+    def _fits(self, turns, budget):
+        return len(turns) <= self.max_recent_turns and sum(count_tokens(turn) for turn in turns) <= budget
+
+    def _summarize(self, summary, turns):
+        """把移出窗口的对话与旧的滚动总结一起总结为新的滚动总结并返回，不修改状态（不持有锁时调用）。"""
+        new_text = "\n".join(turns)
+        prompt = f"""
+角色名称：{self.character_name}
+任务：把已有的对话总结和新的对话内容合并为一个新的对话总结，保留人物、事件、约定和未解决的问题。
+字数限制：不超过{self.summary_token_limit}字。
+<<<
+已有的对话总结：{summary or "无"}
+新的对话内容：
+{new_text}
+>>>
+请仅返回新的对话总结，不要添加额外信息或格式。
+"""
+        new_summary = apis.request_chatgpt(prompt, 0.3)
+        if not new_summary:
+            # 总结失败时退化为直接截断，保证上下文大小仍然受控
+            logger.error("滚动总结失败，改为截断拼接。")
+            new_summary = f"{summary}\n{new_text}".strip()
+        return truncate_tokens(new_summary, self.summary_token_limit)
+
+    def _turns_to_fold(self, turns):
+        """窗口放不下时返回需要折叠的较旧的一批对话，不需要折叠时返回空列表。调用者持有锁。"""
+        unfolded = turns[self._folded_turns:]
+        if self._fits(unfolded, self.token_budget - count_tokens(self.summary)):
+            return []
+        # 一次折叠掉较旧的一批，只保留约一半的窗口，避免每轮都调用一次总结
+        keep_budget = (self.token_budget - self.summary_token_limit) // 2
+        keep = 0
+        while (keep < len(unfolded) - 1 and keep < max(1, self.max_recent_turns // 2)
+               and self._fits(unfolded[len(unfolded) - keep - 1:], keep_budget)):
+            keep += 1
+        keep = max(keep, 1)
+        # 只剩最新的一轮超出预算时没有可折叠的对话，由 render 截断
+        return unfolded[:-keep] if len(unfolded) > keep else []
+
+    def render(self, conversation_history):
+        """
+        返回放进提示词的对话上下文文本：滚动总结（如果有）加上最近的原文对话。
+
+        需要折叠时，总结的LLM调用在锁外进行，完成后只有在状态没有被其他线程改变时才替换滚动总结。
+
+        参数:
+        conversation_history (list): 会话从开头到当前轮的对话历史。
+
+        返回:
+        str: 对话上下文，token数不超过 token_budget。
+        """
+        turns = [text for text in (self._format_turn(turn) for turn in conversation_history or []) if text]
+        with self._lock:
+            if len(turns) < self._folded_turns:
+                # 对话历史比已折叠的还短，说明开始了新的会话
+                self.summary = ""
+                self._folded_turns = 0
+            summary, folded_turns = self.summary, self._folded_turns
+            to_fold = self._turns_to_fold(turns)
+
+        if to_fold:
+            new_summary = self._summarize(summary, to_fold)
+            with self._lock:
+                if self.summary == summary and self._folded_turns == folded_turns:
+                    self.summary = new_summary
+                    self._folded_turns = folded_turns + len(to_fold)
+                    logger.info(f"更新了滚动对话总结：{self.summary}")
+
+        with self._lock:
+            recent = "\n".join(turns[self._folded_turns:])
+            # 单轮对话本身超出预算时只保留最新的部分，保证上限
+            recent = truncate_tokens(recent, self.token_budget - count_tokens(self.summary), keep_end=True)
+            if self.summary:
+                return f"之前的对话总结：{self.summary}\n最近的对话：\n{recent}"
+            return recent
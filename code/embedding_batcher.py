@@ -0,0 +1,156 @@
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    EmbeddingBatcher 类把多个线程（会话）同时发起的单条文本嵌入请求合并为一次批量请求。
+
+    调用者提交文本后得到一个 Future；后台线程在第一条文本入队后最多等待 max_wait 秒，或者凑满 max_batch_size 条
+    不同的文本时，用一次 request_fn 调用获取整批向量，再逐个完成 Future。同一批次中的重复文本只请求一次，
+    共享同一个 Future。每条文本可以带一个优先级（数值越小越紧急），一批请求采用其中最紧急的优先级。
+    各批次在最多 max_concurrent_batches 个工作线程中并行请求，等待配额的低优先级批次不会阻塞之后的批次。
+
+    方法:
+    - submit(text, priority): 提交一条文本，返回结果为嵌入向量（失败时为 None）的 concurrent.futures.Future。
+    - embed(text, priority): submit 的阻塞版本，直接返回嵌入向量。
+    - async_embed(text, priority): submit 的异步版本，可以在事件循环中 await。
+    - close(): 发出剩余的批次并停止后台线程。
+    - stats(): 返回请求次数、文本条数和合并的重复文本数量。
+    """
+    def __init__(self, request_fn, max_batch_size=64, max_wait=0.005, max_concurrent_batches=4):
+        """
+        参数:
+        request_fn (callable): 接收 (文本列表, 优先级)、返回顺序一致的嵌入向量列表（失败时返回 None）的函数。
+        max_batch_size (int): 一次批量请求最多包含的不同文本数量。
+        max_wait (float): 第一条文本入队后最多等待多少秒再发出批量请求。
+        max_concurrent_batches (int): 同时进行的批量请求数量上限。
+        """
+        self.request_fn = request_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # 按入队顺序保存的 {文本: Future}，重复文本复用已有的 Future
+        self._pending = {}
+        # 待处理文本的优先级，重复提交时取更紧急的一个
+        self._priorities = {}
+        self._first_enqueued = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix="embedding_batch")
+        self._closed = False
+        self.requests = 0
+        self.texts = 0
+        self.coalesced = 0
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="embedding_batcher", daemon=True)
+            self._thread.start()
+
+    def submit(self, text, priority=0):
+        """
+        提交一条文本。
+
+        参数:
+        text (str): 需要获取嵌入向量的文本。
+        priority (int): 优先级，数值越小越紧急。
+
+        返回:
+        Future: 结果为该文本的嵌入向量，请求失败时为 None。
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("EmbeddingBatcher 已经关闭")
+            future = self._pending.get(text)
+            if future is not None:
+                self.coalesced += 1
+                self._priorities[text] = min(self._priorities[text], priority)
+                return future
+            future = Future()
+            self._pending[text] = future
+            self._priorities[text] = priority
+            if self._first_enqueued is None:
+                self._first_enqueued = time.monotonic()
+            self._ensure_thread()
+            self._condition.notify()
+        return future
+
+    def embed(self, text, priority=0):
+        """提交一条文本并等待它的嵌入向量，失败时返回 None。"""
+        return self.submit(text, priority).result()
+
+    async def async_embed(self, text, priority=0):
+        """提交一条文本并在事件循环中等待它的嵌入向量，失败时返回 None。"""
+        return await asyncio.wrap_future(self.submit(text, priority))
+
+    def _take_batch(self):
+        """等待到批次凑满或超时，取出一批文本。关闭且没有待处理文本时返回 None。"""
+        with self._condition:
+            while True:
+                if self._pending:
+                    waited = time.monotonic() - self._first_enqueued
+                    if self._closed or len(self._pending) >= self.max_batch_size or waited >= self.max_wait:
+                        break
+                    self._condition.wait(self.max_wait - waited)
+                elif self._closed:
+                    return None
+                else:
+                    self._condition.wait()
+
+            texts = list(self._pending)[:self.max_batch_size]
+            batch = [(text, self._pending.pop(text), self._priorities.pop(text)) for text in texts]
+            # 超出本批次的文本从现在开始重新计时
+            self._first_enqueued = time.monotonic() if self._pending else None
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._executor.submit(self._flush, batch)
+
+    def _flush(self, batch):
+        texts = [text for text, _, _ in batch]
+        priority = min(priority for _, _, priority in batch)
+        try:
+            embeddings = self.request_fn(texts, priority)
+        except Exception as e:
+            logger.error(f"批量获取{len(texts)}条文本的嵌入向量时发生错误：{e}")
+            embeddings = None
+        if embeddings is not None and len(embeddings) != len(texts):
+            logger.error(f"批量嵌入请求返回了{len(embeddings)}个向量，预期{len(texts)}个")
+            embeddings = None
+
+        with self._condition:
+            self.requests += 1
+            self.texts += len(texts)
+        for i, (_, future, _) in enumerate(batch):
+            future.set_result(embeddings[i] if embeddings is not None else None)
+
+    def close(self):
+        """发出所有待处理的文本并停止后台线程。"""
+        with self._condition:
+            self._closed = True
+            thread = self._thread
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join()
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        """
+        返回批处理的统计信息。
+
+        返回:
+        dict: {"requests": 发出的批量请求次数, "texts": 请求的文本条数, "coalesced": 合并掉的重复文本数,
+               "pending": 正在等待的文本条数}
+        """
+        with self._condition:
+            return {"requests": self.requests, "texts": self.texts, "coalesced": self.coalesced,
+                    "pending": len(self._pending)}
@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+
+class EmbeddingCache:
+    """
+    EmbeddingCache 类是一个基于 SQLite 的持久化嵌入向量缓存。
+
+    缓存键是 (模型名, 文本内容的SHA-256)，不同模型的向量互不干扰；向量以 float64 二进制保存，读出后与
+    接口返回的浮点数完全一致。数据库在第一次使用时才打开，可以被多个线程共享。
+
+    方法:
+    - get_many(model, texts): 批量查询，返回命中的 {文本: 向量} 字典。
+    - put_many(model, texts, embeddings): 批量写入。
+    - stats(): 返回命中率等统计信息。
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, "
+                "text_hash TEXT NOT NULL, "
+                "embedding BLOB NOT NULL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model, texts):
+        """
+        批量查询缓存。
+
+        参数:
+        model (str): 嵌入模型名称。
+        texts (list): 文本列表，可以包含重复文本。
+
+        返回:
+        dict: 命中的 {文本: 嵌入向量列表}。
+        """
+        hashes = {self._hash(text): text for text in texts}
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            hash_list = list(hashes)
+            # SQLite 对单条语句的参数数量有限制，分批查询
+            for start in range(0, len(hash_list), 500):
+                batch = hash_list[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[hashes[text_hash]] = array('d', blob).tolist()
+
+            hit_count = sum(1 for text in texts if text in found)
+            self.hits += hit_count
+            self.misses += len(texts) - hit_count
+        return found
+
+    def put_many(self, model, texts, embeddings):
+        """
+        批量写入缓存。
+
+        参数:
+        model (str): 嵌入模型名称。
+        texts (list): 文本列表。
+        embeddings (list): 与文本一一对应的嵌入向量列表。
+        """
+        rows = [(model, self._hash(text), array('d', embedding).tobytes())
+                for text, embedding in zip(texts, embeddings) if embedding]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            conn.commit()
+
+    def stats(self):
+        """
+        返回缓存的统计信息。
+
+        返回:
+        dict: {"hits": 命中次数, "misses": 未命中次数, "hit_rate": 命中率, "entries": 缓存条数}
+        """
+        with self._lock:
+            entries = self._connect().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": entries,
+            }
@@ -0,0 +1,399 @@
+import os
+import sys
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+from vector_index import VectorIndex
+from rwlock import RWLock
+
+SUB_KNOWLEDGE_CACHE_SIZE = 16
+# 子知识嵌入矩阵的量化格式：None（float32）、"int8" 或 "float16"。列式文件用内存映射的全精度段重新打分；
+# 旧的JSON格式文件没有保留全精度向量，只按量化相似度排序
+SUB_KNOWLEDGE_QUANTIZATION = None
+
+# 列式子知识文件的格式标识。头文件仍是 .json，只保存文本和元数据；
+# 嵌入向量以 float32 的 .npy 段保存在同一目录下，读取时使用内存映射。
+COLUMNAR_FORMAT = "columnar"
+
+
+class SubKnowledgeFile:
+    """
+    SubKnowledgeFile 类表示一个已经解析好的子知识文件。
+
+    属性:
+    - file_path: 子知识文件的路径。
+    - summary_text: 子知识文件的知识总结文本。
+    - items: 子知识列表，每个元素为包含 "text" 和 "sub_knowledge" 的字典（不含嵌入向量）。
+    - index: 子知识嵌入向量的归一化矩阵（可能是量化的），第 i 行对应 items[i]。
+    - signature: 解析时文件的 (mtime_ns, size)，用于判断缓存是否过期。
+    """
+    def __init__(self, file_path, summary_text, items, embeddings, signature, quantization=None, exact_rows=None):
+        self.file_path = file_path
+        self.summary_text = summary_text
+        self.items = items
+        self.index = VectorIndex(embeddings, quantization=quantization, exact_rows=exact_rows)
+        self.signature = signature
+
+    @property
+    def dim(self):
+        """嵌入向量的维度，没有有效向量时为0。"""
+        return self.index.dim or 0
+
+    def search(self, query_embedding, top_k=1):
+        """
+        在该文件的子知识中搜索与查询向量最相似的 top_k 项。
+
+        返回:
+        list: 按相似度降序排列的 (item_index, score) 元组列表。
+        """
+        indices, scores = self.index.search(query_embedding, top_k)
+        return [(int(i), float(score)) for i, score in zip(indices, scores)]
+
+
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+
+def file_lock(file_path):
+    """
+    返回子知识文件的进程内读写锁（按绝对路径区分）。读取头文件和嵌入段时持有读锁，
+    读-改-写头文件、写入或删除嵌入段时持有写锁，避免并发的追加互相覆盖或读到已被删除的段。
+    """
+    key = os.path.abspath(file_path)
+    with _file_locks_guard:
+        lock = _file_locks.get(key)
+        if lock is None:
+            lock = _file_locks[key] = RWLock()
+        return lock
+
+
+def file_signature(file_path):
+    """返回文件的 (mtime_ns, size)，文件不存在时抛出 FileNotFoundError。"""
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _write_header(file_path, header):
+    """先写临时文件再原子替换，避免写到一半时头文件损坏。"""
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'w', encoding="utf-8") as file:
+        json.dump(header, file, ensure_ascii=False, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+def _segment_path(file_path, segment_file):
+    """段文件名相对于头文件所在目录保存。"""
+    return os.path.join(os.path.dirname(file_path), segment_file)
+
+
+def _write_segment(file_path, header, embeddings):
+    """
+    把一组嵌入向量写成一个新的 float32 段，并登记到头文件的段列表中（头文件本身由调用者写入）。
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim != 2 or embeddings.shape[0] == 0:
+        return
+    if header.get("dim") is None:
+        header["dim"] = int(embeddings.shape[1])
+    elif embeddings.shape[1] != header["dim"]:
+        raise ValueError(f"嵌入向量维度 {embeddings.shape[1]} 与子知识文件的维度 {header['dim']} 不一致")
+
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    segment_file = f"{stem}.seg{header['next_segment']}.npy"
+    header["next_segment"] += 1
+    # 同样先写临时文件再原子替换，头文件引用的段总是完整的
+    segment_path = _segment_path(file_path, segment_file)
+    temp_path = f"{segment_path}.tmp"
+    with open(temp_path, 'wb') as file:
+        np.save(file, embeddings)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, segment_path)
+    header["segments"].append({"file": segment_file, "count": int(embeddings.shape[0])})
+
+
+def read_header(file_path):
+    """读取子知识文件的JSON头（旧格式文件则是整个文件）。"""
+    with open(file_path, 'r', encoding="utf-8") as file:
+        return json.load(file)
+
+
+def is_columnar(data):
+    """判断解析后的子知识文件是否为列式格式。"""
+    return data.get("format") == COLUMNAR_FORMAT
+
+
+def open_segments(file_path, header):
+    """以内存映射方式打开列式子知识文件的所有嵌入段。"""
+    return [np.load(_segment_path(file_path, segment["file"]), mmap_mode="r")
+            for segment in header.get("segments", [])]
+
+
+def segment_rows(segments):
+    """
+    返回一个按全局行号从多个内存映射段中取行的函数，用于量化检索后的全精度重新打分。
+    """
+    offsets = np.cumsum([0] + [len(segment) for segment in segments])
+
+    def rows(indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        owners = np.searchsorted(offsets, indices, side="right") - 1
+        return np.stack([segments[owner][i - offsets[owner]] for owner, i in zip(owners, indices)])
+    return rows
+
+
+def read_embeddings(file_path, header):
+    """
+    以内存映射方式读取列式子知识文件的所有嵌入段。
+
+    返回:
+    np.ndarray: 形状为 (子知识条数, dim) 的 float32 矩阵。只有一个段时直接返回内存映射数组。
+    """
+    segments = open_segments(file_path, header)
+    if not segments:
+        return np.empty((0, header.get("dim") or 0), dtype=np.float32)
+    if len(segments) == 1:
+        return segments[0]
+    return np.concatenate(segments, axis=0)
+
+
+def write_sub_knowledge_file(file_path, summary_text, sub_knowledge_list):
+    """
+    以列式格式写入一个子知识文件。
+
+    参数:
+    file_path (str): 头文件路径（.json）。
+    summary_text (str): 知识总结文本。
+    sub_knowledge_list (list): 子知识列表，元素包含 "text"、"embedding" 和可选的 "sub_knowledge"。
+    """
+    with file_lock(file_path).write():
+        _write_sub_knowledge_file(file_path, summary_text, sub_knowledge_list)
+
+
+def _write_sub_knowledge_file(file_path, summary_text, sub_knowledge_list):
+    remove_segments(file_path)
+    header = {
+        "format": COLUMNAR_FORMAT,
+        "summary_text": summary_text,
+        "dim": None,
+        "next_segment": 0,
+        "segments": [],
+        "sub_knowledge_list": [{"text": item["text"], "sub_knowledge": item.get("sub_knowledge")}
+                               for item in sub_knowledge_list],
+    }
+    if sub_knowledge_list:
+        _write_segment(file_path, header, [item["embedding"] for item in sub_knowledge_list])
+    _write_header(file_path, header)
+
+
+def append_sub_knowledge(file_path, sub_knowledge_items):
+    """
+    把新的子知识追加为列式文件的一个新段。旧格式的JSON文件会先被转换为列式格式。
+
+    参数:
+    file_path (str): 子知识文件路径。
+    sub_knowledge_items (list): 要追加的子知识，元素包含 "text"、"embedding" 和可选的 "sub_knowledge"。
+    """
+    with file_lock(file_path).write():
+        header = read_header(file_path)
+        if not is_columnar(header):
+            header = convert_json_to_columnar(file_path)
+
+        _write_segment(file_path, header, [item["embedding"] for item in sub_knowledge_items])
+        header["sub_knowledge_list"].extend({"text": item["text"], "sub_knowledge": item.get("sub_knowledge")}
+                                            for item in sub_knowledge_items)
+        _write_header(file_path, header)
+
+
+def delete_sub_knowledge(file_path, index):
+    """
+    从子知识文件中删除一条子知识，并把剩余的嵌入段压缩成一个段。
+
+    参数:
+    file_path (str): 子知识文件路径。
+    index (int): 要删除的子知识索引。
+
+    返回:
+    str: 被删除的子知识文本。索引越界时抛出 IndexError。
+    """
+    with file_lock(file_path).write():
+        return _delete_sub_knowledge(file_path, index)
+
+
+def _delete_sub_knowledge(file_path, index):
+    header = read_header(file_path)
+    if not is_columnar(header):
+        header = convert_json_to_columnar(file_path)
+
+    items = header["sub_knowledge_list"]
+    if not 0 <= index < len(items):
+        raise IndexError(index)
+
+    embeddings = np.delete(np.asarray(read_embeddings(file_path, header)), index, axis=0)
+    text = items.pop(index)["text"]
+    old_segments = header["segments"]
+    header["segments"] = []
+    _write_segment(file_path, header, embeddings)
+    _write_header(file_path, header)
+
+    # 新头文件写入后再删除旧段，中途失败也不会留下指向不存在段的头文件
+    for segment in old_segments:
+        segment_path = _segment_path(file_path, segment["file"])
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+    return text
+
+
+def remove_segments(file_path):
+    """删除列式子知识文件的所有嵌入段（不删除头文件）。"""
+    if not os.path.exists(file_path):
+        return
+    try:
+        header = read_header(file_path)
+    except (json.JSONDecodeError, OSError):
+        return
+    for segment in header.get("segments", []):
+        segment_path = _segment_path(file_path, segment["file"])
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+
+
+def remove_sub_knowledge_file(file_path):
+    """删除子知识文件及其所有嵌入段。"""
+    with file_lock(file_path).write():
+        remove_segments(file_path)
+        os.remove(file_path)
+
+
+def convert_json_to_columnar(file_path):
+    """
+    把旧格式（嵌入向量以JSON浮点数保存）的子知识文件原地转换为列式格式。
+
+    参数:
+    file_path (str): 子知识文件路径。
+
+    返回:
+    dict: 转换后的头信息。文件已经是列式格式时直接返回其头信息。
+    """
+    with file_lock(file_path).write():
+        data = read_header(file_path)
+        if is_columnar(data):
+            return data
+        _write_sub_knowledge_file(file_path, data.get("summary_text", ""), data.get("sub_knowledge_list", []))
+        return read_header(file_path)
+
+
+def load_sub_knowledge_file(file_path, quantization=SUB_KNOWLEDGE_QUANTIZATION):
+    """
+    读取并解析一个子知识文件（列式格式或旧的JSON格式），把嵌入向量转换为归一化矩阵。
+
+    参数:
+    file_path (str): 子知识文件的路径。
+    quantization: 嵌入矩阵的量化格式，见 SUB_KNOWLEDGE_QUANTIZATION。
+
+    返回:
+    SubKnowledgeFile: 解析后的子知识文件。文件不存在时抛出 FileNotFoundError，缺少必要的键时抛出 KeyError。
+    """
+    # 头文件和它引用的嵌入段在同一个读锁内打开，不会读到写者正在替换的段；
+    # 段以内存映射打开，之后即使文件被删除映射仍然有效
+    with file_lock(file_path).read():
+        signature = file_signature(file_path)
+        data = read_header(file_path)
+
+        sub_knowledge_list = data["sub_knowledge_list"]
+        items = [{"text": item["text"], "sub_knowledge": item.get("sub_knowledge")} for item in sub_knowledge_list]
+        exact_rows = None
+        if is_columnar(data):
+            embeddings = read_embeddings(file_path, data)
+            if quantization is not None:
+                exact_rows = segment_rows(open_segments(file_path, data))
+        else:
+            embeddings = [item.get("embedding", []) for item in sub_knowledge_list]
+    return SubKnowledgeFile(file_path, data.get("summary_text", ""), items, embeddings, signature,
+                            quantization, exact_rows)
+
+
+class SubKnowledgeCache:
+    """
+    SubKnowledgeCache 类是一个容量有限的 LRU 缓存，保存已解析的子知识文件。
+
+    缓存以文件的绝对路径为键。每次读取时都会比较文件的 mtime 和大小，文件在进程外被修改时自动重新加载；
+    进程内的写入路径应调用 invalidate() 主动失效。
+
+    方法:
+    - get(file_path): 获取解析后的子知识文件，必要时从磁盘加载。
+    - invalidate(file_path): 使指定文件的缓存失效。
+    - clear(): 清空缓存。
+    """
+    def __init__(self, max_entries=SUB_KNOWLEDGE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(file_path):
+        return os.path.abspath(file_path)
+
+    def get(self, file_path):
+        """
+        获取解析后的子知识文件。
+
+        参数:
+        file_path (str): 子知识文件的路径。
+
+        返回:
+        SubKnowledgeFile: 解析后的子知识文件。文件不存在时抛出 FileNotFoundError。
+        """
+        key = self._key(file_path)
+        signature = file_signature(file_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.signature == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = load_sub_knowledge_file(file_path)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, file_path):
+        """使指定文件的缓存失效。"""
+        with self._lock:
+            self._entries.pop(self._key(file_path), None)
+
+    def clear(self):
+        """清空缓存。"""
+        with self._lock:
+            self._entries.clear()
+
+
+# 进程内共享的子知识文件缓存
+sub_knowledge_cache = SubKnowledgeCache()
+
+
+if __name__ == "__main__":
+    # 把旧格式的子知识文件转换为列式格式：python knowledge_store.py [文件或目录 ...]
+    targets = sys.argv[1:] or ["../resource/knowledge"]
+    for target in targets:
+        if os.path.isdir(target):
+            paths = [os.path.join(target, name) for name in sorted(os.listdir(target)) if name.endswith(".json")]
+        else:
+            paths = [target]
+        for path in paths:
+            before = os.path.getsize(path)
+            if is_columnar(read_header(path)):
+                print(f"{path} 已经是列式格式，跳过")
+                continue
+            convert_json_to_columnar(path)
+            print(f"转换了 {path}：{before} 字节 -> 头文件 {os.path.getsize(path)} 字节")
@@ -0,0 +1,243 @@
+import re
+import json
+import time
+import logging
+import threading
+import weakref
+from collections import deque
+import numpy as np
+import apis
+from ann_index import spherical_kmeans
+
+# 每分钟最多发起的总结请求（LLM调用）次数
+CONSOLIDATION_CALLS_PER_MINUTE = 6
+# 后台线程没有被唤醒时检查记忆流的间隔（秒）
+CONSOLIDATION_INTERVAL = 30.0
+# 聚类时每个簇的目标大小，聚类数量取 记忆条数 // CLUSTER_TARGET_SIZE
+CLUSTER_TARGET_SIZE = 5
+# 参与总结的簇至少包含的记忆条数
+MIN_CLUSTER_SIZE = 2
+# 一次LLM调用中总结的簇数量
+CLUSTERS_PER_CALL = 3
+
+logger = logging.getLogger(__name__)
+
+
+def cluster_memories(matrix, target_size=CLUSTER_TARGET_SIZE, min_size=MIN_CLUSTER_SIZE, seed=0):
+    """
+    在归一化的记忆矩阵上运行球面 k-means，按密度从高到低返回簇。
+
+    参数:
+    matrix (np.ndarray): 归一化的记忆嵌入矩阵，第 i 行对应记忆流的第 i 条记忆。
+    target_size (int): 每个簇的目标大小。
+    min_size (int): 簇的最小大小，更小的簇被忽略。
+    seed (int): 随机种子。
+
+    返回:
+    list: 按密度（簇内向量与簇中心的平均余弦相似度）降序排列的 (密度, 行号列表) 元组。
+    """
+    valid = np.flatnonzero(np.linalg.norm(matrix, axis=1) > 0)
+    if len(valid) < min_size:
+        return []
+    vectors = matrix[valid]
+    n_clusters = max(1, len(vectors) // target_size)
+    centroids = spherical_kmeans(vectors, n_clusters, seed=seed)
+    similarities = vectors @ centroids.T
+    assign = np.argmax(similarities, axis=1)
+
+    clusters = []
+    for cluster_id in range(len(centroids)):
+        members = np.flatnonzero(assign == cluster_id)
+        if len(members) >= min_size:
+            density = float(similarities[members, cluster_id].mean())
+            clusters.append((density, valid[members].tolist()))
+    clusters.sort(key=lambda cluster: cluster[0], reverse=True)
+    return clusters
+
+
+def parse_summaries(response, count):
+    """
+    解析批量总结的回复。优先按JSON数组解析，失败时按“【序号】”分段解析。
+
+    返回:
+    list: 长度为 count 的总结列表，无法解析的位置为 None。
+    """
+    summaries = [None] * count
+    if not response:
+        return summaries
+    match = re.search(r"\[.*\]", response, re.S)
+    if match:
+        try:
+            parsed = json.loads(match.group(0))
+            for i, summary in enumerate(parsed[:count]):
+                if isinstance(summary, str) and summary.strip():
+                    summaries[i] = summary.strip()
+            return summaries
+        except json.JSONDecodeError:
+            pass
+    for number, summary in re.findall(r"【(\d+)】\s*(.+?)(?=【\d+】|$)", response, re.S):
+        index = int(number) - 1
+        if 0 <= index < count and summary.strip():
+            summaries[index] = summary.strip()
+    return summaries
+
+
+class MemoryConsolidator:
+    """
+    MemoryConsolidator 类在后台线程中整理 Brain 的记忆流，代替 add_memory 中同步执行的记忆总结。
+
+    记忆条数达到 brain.memory_limit 后，工作线程对记忆矩阵聚类，把最密集的几个簇放在一次LLM调用中分别总结，
+    再通过 brain.replace_memories() 原子地用总结记忆替换簇内的原始记忆。总结期间被删除或修改过的簇会被跳过。
+    LLM调用次数受每分钟预算限制。
+
+    除了创建时传入的基础大脑，由它 fork_session() 出的会话大脑也注册到同一个整理器上（弱引用，会话被换出后自动移除），
+    工作线程依次检查所有已注册的记忆流，所有会话共享同一份调用预算。
+
+    方法:
+    - start(): 启动后台线程。
+    - stop(): 停止后台线程。
+    - register(brain) / unregister(brain): 注册/移除需要整理的（会话）大脑。
+    - notify(): 唤醒后台线程检查记忆流（add_memory 之后调用）。
+    - consolidate_once(brain): 同步整理一个大脑（默认为基础大脑）的记忆流，返回被替换的簇数量。
+    """
+    def __init__(self, brain, calls_per_minute=CONSOLIDATION_CALLS_PER_MINUTE, interval=CONSOLIDATION_INTERVAL,
+                 clusters_per_call=CLUSTERS_PER_CALL):
+        self.brain = brain
+        self.calls_per_minute = calls_per_minute
+        self.interval = interval
+        self.clusters_per_call = clusters_per_call
+        self._call_times = deque()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._brains = weakref.WeakSet()
+        self._brains_lock = threading.Lock()
+
+    def register(self, brain):
+        """注册一个需要整理的大脑，并把整理器挂接到它上面（它的 add_memory 之后只唤醒整理器）。"""
+        with self._brains_lock:
+            self._brains.add(brain)
+        brain.attach_consolidator(self)
+
+    def unregister(self, brain):
+        """移除一个大脑（例如被换出的会话），之后不再整理它的记忆流。"""
+        with self._brains_lock:
+            self._brains.discard(brain)
+
+    def _registered(self):
+        with self._brains_lock:
+            return [self.brain] + [brain for brain in self._brains if brain is not self.brain]
+
+    def start(self):
+        """启动后台线程，并把自己挂接到 brain 上。"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=f"{self.brain.name}_consolidator", daemon=True)
+        self._thread.start()
+        self.brain.attach_consolidator(self)
+
+    def stop(self, timeout=None):
+        """停止后台线程。正在进行的LLM调用完成后线程才会退出。"""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def notify(self):
+        """唤醒后台线程检查记忆流。"""
+        self._wake.set()
+
+    def _budget_wait(self):
+        """距离下一次允许的LLM调用还需要等待的秒数。"""
+        now = time.monotonic()
+        while self._call_times and now - self._call_times[0] >= 60:
+            self._call_times.popleft()
+        if len(self._call_times) < self.calls_per_minute:
+            return 0.0
+        return 60 - (now - self._call_times[0])
+
+    @staticmethod
+    def _needs_consolidation(brain):
+        return len(brain.memory_stream) >= brain.memory_limit
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            for brain in self._registered():
+                self._consolidate_brain(brain)
+
+    def _consolidate_brain(self, brain):
+        """在调用预算内反复整理一个大脑，直到记忆条数低于上限或整理不出新的簇。"""
+        while not self._stopped.is_set() and self._needs_consolidation(brain):
+            wait = self._budget_wait()
+            if wait > 0:
+                logger.info(f"记忆整理的调用预算已用完，{wait:.1f}秒后再试。")
+                self._stopped.wait(wait)
+                continue
+            try:
+                if not self.consolidate_once(brain):
+                    return
+            except Exception as e:
+                logger.error(f"后台整理记忆时发生错误：{e}")
+                return
+
+    def _summary_prompt(self, brain, groups):
+        sections = "\n".join(f"【{i + 1}】" + " ".join(memory["description"] for memory in group)
+                             for i, group in enumerate(groups))
+        return f"""
+角色名称：{brain.name}
+初始记忆：{brain.seed_memory}
+任务：基于角色第一视角进行思考，分别提取并总结下面每一组相似记忆描述中的关键信息。
+字数限制：每组不超过100字。
+记忆描述（共{len(groups)}组，以【序号】分隔）：
+<<<
+{sections}
+>>>
+请以第一人称视角为每一组编写一个高语义层次的总结，不要改变原始记忆的内容或添加额外信息。
+只输出一个JSON字符串数组，第i个元素是第i组的总结，不要输出其他内容。
+"""
+
+    def consolidate_once(self, brain=None):
+        """
+        同步执行一轮整理：聚类、批量总结最密集的簇、原子替换。
+
+        参数:
+        brain (Brain, optional): 要整理的大脑，默认为基础大脑。
+
+        返回:
+        int: 成功替换的簇数量。
+        """
+        brain = brain or self.brain
+        brain._sync_memory_index()
+        with brain._memory_lock.read():
+            matrix = brain.memory_index.matrix.copy()
+            memories = list(brain.memory_stream)
+        clusters = cluster_memories(matrix)[:self.clusters_per_call]
+        if not clusters:
+            logger.info("记忆流中没有可以整理的簇。")
+            return 0
+
+        groups = [[memories[i] for i in rows] for _, rows in clusters]
+        self._call_times.append(time.monotonic())
+        response = apis.request_chatgpt(self._summary_prompt(brain, groups), 0.5, priority=apis.PRIORITY_BACKGROUND)
+        summaries = parse_summaries(response, len(groups))
+        pending = [(group, summary) for group, summary in zip(groups, summaries) if summary]
+        if not pending:
+            logger.error("未能从回复中解析出记忆总结。")
+            return 0
+
+        embeddings = apis.request_embedding([summary for _, summary in pending], priority=apis.PRIORITY_BACKGROUND)
+        if not embeddings or len(embeddings) != len(pending):
+            logger.error("API未能生成总结记忆的嵌入向量。")
+            return 0
+
+        replaced = 0
+        time_string = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        for (group, summary), embedding in zip(pending, embeddings):
+            memory = {"description": summary, "create_time": time_string, "embedding": embedding}
+            if brain.replace_memories(group, memory):
+                replaced += 1
+        logger.info(f"后台整理了{replaced}组记忆。")
+        return replaced
@@ -125,7 +125,7 @@ class Perception:
         """
         try:
             # 请求每个段落的嵌入表示
-            embeddings = apis.request_embedding(segments)
+            embeddings = apis.request_embedding(segments, priority=apis.PRIORITY_BULK)
         except Exception as e:
             print(f"请求嵌入表示时发生错误：{e}")
             return []
@@ -0,0 +1,98 @@
+import os
+import time
+import json
+import argparse
+import numpy as np
+import knowledge_store
+from vector_index import VectorIndex, top_k_indices
+
+
+def load_knowledge_vectors(knowledge_dir, extra_files=()):
+    """
+    读取知识目录下所有子知识文件（列式或旧的JSON格式）以及额外JSON文件中的嵌入向量。
+
+    返回:
+    np.ndarray: 所有有效嵌入向量组成的 float32 矩阵。
+    """
+    vectors = []
+    for name in sorted(os.listdir(knowledge_dir)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(knowledge_dir, name)
+        header = knowledge_store.read_header(path)
+        if knowledge_store.is_columnar(header):
+            vectors.extend(np.asarray(knowledge_store.read_embeddings(path, header)))
+        else:
+            vectors.extend(item["embedding"] for item in header["sub_knowledge_list"] if item.get("embedding"))
+
+    for path in extra_files:
+        with open(path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        items = data.get("basic_knowledge", []) if isinstance(data, dict) else data
+        vectors.extend(item["embedding"] for item in items if item.get("embedding"))
+
+    dims = [len(vector) for vector in vectors]
+    dim = max(set(dims), key=dims.count)
+    return np.asarray([vector for vector in vectors if len(vector) == dim], dtype=np.float32)
+
+
+def synthesize(vectors, size, noise, rng):
+    """以真实向量为中心加噪声扩充语料，模拟更大的知识库。"""
+    if size <= len(vectors):
+        return vectors
+    centers = vectors[rng.integers(0, len(vectors), size - len(vectors))]
+    extra = centers + rng.normal(0, noise, centers.shape).astype(np.float32) * np.abs(vectors).mean()
+    return np.concatenate([vectors, extra])
+
+
+def evaluate(corpus, queries, quantization, top_k):
+    """
+    返回某种量化格式的内存占用、召回率和平均查询延迟。召回率以 float32 精确检索的 top_k 为基准。
+    """
+    exact = VectorIndex(corpus)
+    index = VectorIndex(corpus, quantization=quantization, exact_rows=lambda rows: corpus[rows])
+    truth = [set(exact.search(query, top_k)[0].tolist()) for query in queries]
+
+    approximate_hits, rescored_hits, elapsed = 0, 0, 0.0
+    for query, expected in zip(queries, truth):
+        approximate_hits += len(expected & set(top_k_indices(index.scores(query), top_k)[0].tolist()))
+        start = time.perf_counter()
+        rescored_hits += len(expected & set(index.search(query, top_k)[0].tolist()))
+        elapsed += time.perf_counter() - start
+
+    total = top_k * len(queries)
+    return {
+        "quantization": quantization or "float32",
+        "megabytes": index.nbytes() / 2 ** 20,
+        "recall": approximate_hits / total,
+        "recall_rescored": rescored_hits / total,
+        "latency_ms": elapsed / len(queries) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    # python quantization_benchmark.py [--knowledge-dir ../resource/knowledge] [--synthetic 100000]
+    parser = argparse.ArgumentParser(description="比较量化嵌入矩阵与 float32 精确检索的召回率和内存占用")
+    parser.add_argument("--knowledge-dir", default="../resource/knowledge")
+    parser.add_argument("--extra", nargs="*", default=["../resource/knowledge_units.json", "../resource/hutao.json"])
+    parser.add_argument("--synthetic", type=int, default=0, help="用加噪声的真实向量把语料扩充到该规模")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = load_knowledge_vectors(args.knowledge_dir, args.extra)
+    corpus = synthesize(vectors, args.synthetic, args.noise, rng)
+    # 查询是语料中随机向量的加噪版本，近似真实的“相关但不相同”的查询
+    queries = corpus[rng.integers(0, len(corpus), args.queries)]
+    queries = queries + rng.normal(0, args.noise, queries.shape).astype(np.float32) * np.abs(corpus).mean()
+
+    print(f"语料：{len(vectors)} 条真实向量，扩充后 {len(corpus)} 条，维度 {corpus.shape[1]}，"
+          f"查询 {len(queries)} 条，top_k={args.top_k}")
+    print(f"{'格式':<10}{'内存(MB)':>10}{'召回率':>10}{'重打分召回率':>14}{'延迟(ms)':>10}")
+    for quantization in (None, "float16", "int8"):
+        result = evaluate(corpus, queries, quantization, args.top_k)
+        print(f"{result['quantization']:<10}{result['megabytes']:>10.2f}{result['recall']:>10.4f}"
+              f"{result['recall_rescored']:>14.4f}{result['latency_ms']:>10.3f}")
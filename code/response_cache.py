@@ -0,0 +1,155 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+# 缓存条目的默认有效期（秒）
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
+# 缓存条目数上限，超过时淘汰最久未使用的条目
+RESPONSE_CACHE_MAX_ENTRIES = 20000
+# temperature 按该步长分桶，0.48 和 0.5 视为同一个温度
+TEMPERATURE_BUCKET = 0.1
+
+
+def normalize_prompt(prompt):
+    """规范化提示词：去掉每行首尾空白和空行，把连续空白合并为一个空格，避免排版差异导致缓存未命中。"""
+    lines = (re.sub(r"\s+", " ", line).strip() for line in prompt.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def temperature_bucket(temperature):
+    """把 temperature 映射到分桶后的值。"""
+    return round(round(temperature / TEMPERATURE_BUCKET) * TEMPERATURE_BUCKET, 4)
+
+
+class ResponseCache:
+    """
+    ResponseCache 类是一个基于 SQLite 的持久化LLM回复缓存，用于低温度、近似确定性的内部调用。
+
+    缓存键是 (模型名, 规范化提示词的SHA-256, temperature分桶)。条目超过有效期后视为未命中；
+    条目数超过上限时按最近使用时间淘汰（LRU）。数据库在第一次使用时才打开，可以被多个线程共享。
+
+    方法:
+    - get(model, prompt, temperature): 查询缓存，未命中时返回 None。
+    - put(model, prompt, temperature, response): 写入缓存。
+    - clear(): 清空缓存。
+    - stats(): 返回命中率等统计信息。
+    """
+    def __init__(self, db_path, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "model TEXT NOT NULL, "
+                "prompt_hash TEXT NOT NULL, "
+                "temperature REAL NOT NULL, "
+                "response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (model, prompt_hash, temperature))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _key(model, prompt, temperature):
+        prompt_hash = hashlib.sha256(normalize_prompt(prompt).encode("utf-8")).hexdigest()
+        return model, prompt_hash, temperature_bucket(temperature)
+
+    def get(self, model, prompt, temperature):
+        """
+        查询缓存。
+
+        参数:
+        model (str): 模型名称。
+        prompt (str): 提示词。
+        temperature (float): 温度。
+
+        返回:
+        str: 缓存的回复。未命中或已过期时返回 None。
+        """
+        key = self._key(model, prompt, temperature)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT response, created_at FROM responses WHERE model = ? AND prompt_hash = ? AND temperature = ?",
+                key,
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    conn.execute("DELETE FROM responses WHERE model = ? AND prompt_hash = ? AND temperature = ?", key)
+                    conn.commit()
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE model = ? AND prompt_hash = ? AND temperature = ?",
+                         (now, *key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, model, prompt, temperature, response):
+        """
+        写入缓存，并在条目数超过上限时淘汰最久未使用的条目。
+
+        参数:
+        model (str): 模型名称。
+        prompt (str): 提示词。
+        temperature (float): 温度。
+        response (str): 回复。
+        """
+        if not response:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                         (*self._key(model, prompt, temperature), response, now, now))
+            count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM responses WHERE rowid IN "
+                    "(SELECT rowid FROM responses ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            conn.commit()
+
+    def clear(self):
+        """清空缓存。"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+
+    def stats(self):
+        """
+        返回缓存的统计信息。
+
+        返回:
+        dict: {"hits": 命中次数, "misses": 未命中次数, "hit_rate": 命中率, "entries": 缓存条数}
+        """
+        with self._lock:
+            entries = self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": entries,
+            }
@@ -0,0 +1,92 @@
+import threading
+import contextlib
+
+
+class RWLock:
+    """
+    RWLock 类是一个写者优先的读写锁：多个读者可以同时持有读锁，写者独占。
+
+    有写者在等待时，新的读者会等待，避免写者饿死；但已经持有读锁的线程再次获取读锁时立即成功，
+    不会因为等待中的写者而死锁。写锁可重入，持有写锁的线程也可以获取读锁。
+    持有读锁（且不持有写锁）时获取写锁会抛出 RuntimeError，而不是死锁。
+
+    方法:
+    - read(): 获取读锁的上下文管理器。
+    - write(): 获取写锁的上下文管理器。
+    - acquire_read() / release_read(): 获取/释放读锁。
+    - acquire_write() / release_write(): 获取/释放写锁。
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    def _read_depth(self):
+        return getattr(self._local, "depth", 0)
+
+    def acquire_read(self):
+        """获取读锁。"""
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me and not self._read_depth():
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+            self._readers += 1
+        self._local.depth = self._read_depth() + 1
+
+    def release_read(self):
+        """释放读锁。"""
+        self._local.depth = self._read_depth() - 1
+        with self._condition:
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        """获取写锁。"""
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if self._read_depth():
+                raise RuntimeError("持有读锁时不能获取写锁")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        """释放写锁。"""
+        with self._condition:
+            if self._writer != threading.get_ident():
+                raise RuntimeError("当前线程没有持有写锁")
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def read(self):
+        """获取读锁的上下文管理器。"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        """获取写锁的上下文管理器。"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -0,0 +1,330 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from brain_journal import _encode_item, _decode_item, _write_json_atomic
+
+# 被换出的会话状态保存的目录
+SESSION_DIRECTORY = "../resource/sessions"
+# 内存中最多保留的会话数量，超过时把最久未使用的空闲会话换出到磁盘
+MAX_ACTIVE_SESSIONS = 200
+# 会话空闲超过该时间（秒）后，即使没有超过数量上限也会被换出
+SESSION_IDLE_TIMEOUT = 30 * 60
+
+logger = logging.getLogger(__name__)
+
+
+def memory_key(memory):
+    """
+    返回记忆的稳定标识：创建时间加描述的哈希。基础大脑的记忆流会被后台整理器重排和替换，不能用位置引用记忆。
+    """
+    digest = hashlib.sha256(memory["description"].encode("utf-8")).hexdigest()[:16]
+    return f"{memory['create_time']}#{digest}"
+
+
+class Session:
+    """
+    Session 类保存一个用户会话的状态：会话大脑（独立的记忆流、心情、行动状态和对话上下文）和对话历史。
+
+    方法:
+    - submit(fn, *args, **kwargs): 在会话自己的单线程记账队列中执行回合后的任务，各回合严格按提交顺序执行；
+      设置了 on_update 时每个任务完成后调用它（SessionManager 用来在每个回合后保存会话）。
+    - to_json(base_memories): 导出会话状态，与基础记忆相同的记忆只保存稳定标识。
+    """
+    def __init__(self, session_id, brain, history=None, on_update=None):
+        self.session_id = session_id
+        self.brain = brain
+        self.history = history if history is not None else []
+        self.on_update = on_update
+        self.last_active = time.monotonic()
+        # 正在使用该会话的请求和记账任务数量，大于0时不会被换出
+        self._users = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        # 保存会话时持有，避免记账线程、换出和 save_all 同时写同一个临时文件
+        self.save_lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            self._users += 1
+            self.last_active = time.monotonic()
+
+    def _release(self):
+        with self._lock:
+            self._users -= 1
+            self.last_active = time.monotonic()
+
+    @property
+    def in_use(self):
+        return self._users > 0
+
+    def submit(self, fn, *args, **kwargs):
+        """在会话的记账队列中执行 fn，执行完成前会话不会被换出。返回 Future。"""
+        self._acquire()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"session_{self.session_id}")
+            future = self._executor.submit(self._run_and_update, fn, args, kwargs)
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _run_and_update(self, fn, args, kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if self.on_update is not None:
+                try:
+                    self.on_update(self)
+                except Exception as e:
+                    logger.error(f"会话 {self.session_id} 回合后的更新回调发生错误：{e}")
+
+    def close(self):
+        """等待记账队列中的任务完成并释放工作线程。"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def to_json(self, base_memories):
+        """
+        导出会话状态。
+
+        参数:
+        base_memories (list): 基础大脑的记忆流。会话中仍然与之共享的记忆以 {"base": memory_key(记忆)} 保存，
+                              只有会话自己的记忆完整保存。
+        """
+        base_ids = {id(memory) for memory in base_memories}
+        with self.brain._memory_lock.read():
+            memory_stream = [{"base": memory_key(memory)} if id(memory) in base_ids else _encode_item(memory)
+                             for memory in self.brain.memory_stream]
+        return {
+            "session_id": self.session_id,
+            "memory_stream": memory_stream,
+            "mood": self.brain.fsm.mood,
+            "action_state": self.brain.fsm.action_state,
+            "conversation_context": self.brain.conversation_context.to_json(),
+            "history": self.history,
+        }
+
+
+class SessionManager:
+    """
+    SessionManager 类为每个用户会话提供独立的会话大脑，所有会话共享基础大脑的知识库和知识索引。
+
+    会话大脑由 base_brain.fork_session() 创建，每个会话只额外占用自己的记忆流和状态。会话大脑不挂接日志，
+    每个回合的记账任务完成后会话被保存到 directory，进程崩溃时最多丢失正在进行的回合。内存中的会话数量超过
+    max_sessions 或空闲超过 idle_timeout 时，最久未使用且没有请求正在使用的会话被保存并从内存中移除，
+    之后再次访问时从磁盘恢复。进程退出前应调用 close()。
+
+    管理器的锁只保护会话表，从磁盘恢复会话、关闭和保存被换出的会话都在锁外进行。正在恢复或换出的会话在表中
+    登记一个 Future，只有访问同一个会话ID的请求等待它完成，其他会话的请求不受影响。
+
+    方法:
+    - session(session_id): 上下文管理器，返回会话并在使用期间阻止它被换出。
+    - get(session_id): 返回会话（不存在时从磁盘恢复或新建）。
+    - evict(session_id): 把会话保存到磁盘并从内存中移除。
+    - save_all(): 把内存中的所有会话保存到磁盘。
+    - close(): 保存并关闭所有会话。
+    - stats(): 返回会话数量等统计信息。
+    """
+    def __init__(self, base_brain, directory=SESSION_DIRECTORY, max_sessions=MAX_ACTIVE_SESSIONS,
+                 idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.base_brain = base_brain
+        self.directory = directory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+        # 正在从磁盘恢复（或新建）和正在换出的会话ID -> Future，完成后访问该ID的请求重新查找
+        self._loading = {}
+        self._evicting = {}
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.restores = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _session_path(self, session_id):
+        # 会话ID来自客户端，只保留安全的字符作为文件名
+        return os.path.join(self.directory, f"{re.sub(r'[^0-9A-Za-z_-]', '_', str(session_id))}.json")
+
+    def _new_session(self, session_id):
+        return Session(session_id, self.base_brain.fork_session(), on_update=self._save_session)
+
+    def _load_session(self, session_id):
+        """从磁盘恢复会话，文件不存在或损坏时返回 None。"""
+        path = self._session_path(session_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"会话 {session_id} 的状态文件无法读取，重新创建会话：{e}")
+            return None
+
+        with self.base_brain._memory_lock.read():
+            base_memories = {}
+            for memory in self.base_brain.memory_stream:
+                base_memories.setdefault(memory_key(memory), memory)
+        memory_stream, unresolved = [], 0
+        for memory in data.get("memory_stream", []):
+            if "base" not in memory:
+                memory_stream.append(_decode_item(memory))
+            elif memory["base"] in base_memories:
+                memory_stream.append(base_memories[memory["base"]])
+            else:
+                # 共享的基础记忆已经被整理或删除
+                unresolved += 1
+        if unresolved:
+            logger.warning(f"会话 {session_id} 引用的{unresolved}条基础记忆已经不在基础大脑中，恢复时被跳过。")
+        brain = self.base_brain.fork_session(memory_stream)
+        brain.fsm.set_mood(data.get("mood"), "恢复会话")
+        brain.fsm.set_action_state(data.get("action_state"), "恢复会话")
+        brain.conversation_context.load_json(data.get("conversation_context", {}))
+        return Session(session_id, brain, data.get("history", []), on_update=self._save_session)
+
+    def _save_session(self, session):
+        with session.save_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            _write_json_atomic(self._session_path(session.session_id),
+                               session.to_json(self.base_brain.memory_stream))
+
+    def get(self, session_id):
+        """
+        返回会话，并把它标记为最近使用。
+
+        参数:
+        session_id (str): 会话ID，例如 Gradio 的 request.session_hash。
+
+        返回:
+        Session: 内存中的会话；不在内存中时从磁盘恢复，磁盘上也没有时新建。
+        """
+        return self._get(session_id, acquire=False)
+
+    @contextlib.contextmanager
+    def session(self, session_id):
+        """返回会话，并在 with 块执行期间阻止它被换出。"""
+        session = self._get(session_id, acquire=True)
+        try:
+            yield session
+        finally:
+            session._release()
+
+    def _get(self, session_id, acquire):
+        """get 的实现。acquire 为 True 时在管理器的锁内标记会话正在使用，之后不会被选中换出。"""
+        while True:
+            with self._lock:
+                session = self._sessions.get(session_id)
+                if session is not None:
+                    self._sessions.move_to_end(session_id)
+                    evicted = self._touch(session, acquire)
+                    break
+                pending = self._loading.get(session_id) or self._evicting.get(session_id)
+                if pending is None:
+                    loading = self._loading[session_id] = Future()
+                    break
+            # 同一个会话正在恢复或换出（保存完成后才能从磁盘恢复），等待后重新查找
+            pending.exception()
+
+        if session is None:
+            try:
+                loaded = self._load_session(session_id)
+                session = loaded or self._new_session(session_id)
+            except BaseException as e:
+                with self._lock:
+                    del self._loading[session_id]
+                loading.set_exception(e)
+                raise
+            with self._lock:
+                del self._loading[session_id]
+                self._sessions[session_id] = session
+                if loaded is not None:
+                    self.restores += 1
+                logger.info(f"加载了会话 {session_id}，当前共{len(self._sessions)}个会话。")
+                evicted = self._touch(session, acquire)
+            loading.set_result(session)
+
+        self._finish_evictions(evicted)
+        return session
+
+    def _touch(self, session, acquire):
+        """在管理器的锁内更新会话的使用时间，按需标记使用，并选出需要换出的会话（由调用者在锁外完成换出）。"""
+        session.last_active = time.monotonic()
+        if acquire:
+            session._acquire()
+        return self._take_idle(keep=session.session_id)
+
+    def _take_idle(self, keep=None):
+        """在管理器的锁内按LRU顺序选出超过数量上限或空闲超时的会话并从会话表中移除，正在使用的会话跳过。"""
+        now = time.monotonic()
+        evicted = []
+        for session_id, session in list(self._sessions.items()):
+            over_limit = len(self._sessions) > self.max_sessions
+            idle = now - session.last_active > self.idle_timeout
+            if not over_limit and not idle:
+                # 后面的会话更近使用，不会空闲更久
+                break
+            if session_id != keep and not session.in_use:
+                evicted.append(self._detach(session_id))
+        return evicted
+
+    def _detach(self, session_id):
+        """在管理器的锁内把会话从会话表中移除，并登记为正在换出。"""
+        future = self._evicting[session_id] = Future()
+        return session_id, self._sessions.pop(session_id), future
+
+    def _finish_evictions(self, evicted):
+        """在管理器的锁外关闭并保存被移除的会话，完成后等待该会话的请求才会从磁盘恢复它。"""
+        for session_id, session, future in evicted:
+            try:
+                session.close()
+                if session.brain.consolidator is not None:
+                    session.brain.consolidator.unregister(session.brain)
+                try:
+                    self._save_session(session)
+                except OSError as e:
+                    logger.error(f"保存会话 {session_id} 时发生错误：{e}")
+            finally:
+                with self._lock:
+                    del self._evicting[session_id]
+                    self.evictions += 1
+                    logger.info(f"换出了会话 {session_id}，当前共{len(self._sessions)}个会话。")
+                future.set_result(None)
+
+    def evict(self, session_id):
+        """把会话保存到磁盘并从内存中移除。会话不在内存中时什么也不做。"""
+        with self._lock:
+            if session_id not in self._sessions:
+                return
+            evicted = [self._detach(session_id)]
+        self._finish_evictions(evicted)
+
+    def save_all(self):
+        """把内存中的所有会话保存到磁盘（不移除）。"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            self._save_session(session)
+
+    def close(self):
+        """保存并移除所有会话。"""
+        with self._lock:
+            evicted = [self._detach(session_id) for session_id in list(self._sessions)]
+        self._finish_evictions(evicted)
+
+    def stats(self):
+        """
+        返回会话的统计信息。
+
+        返回:
+        dict: {"active": 内存中的会话数量, "evictions": 换出次数, "restores": 从磁盘恢复的次数}
+        """
+        with self._lock:
+            return {"active": len(self._sessions), "evictions": self.evictions, "restores": self.restores}
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 模块都平铺在 code/ 目录下，测试从仓库任意位置运行时都能导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,158 @@
+import threading
+import time
+import numpy as np
+import pytest
+import knowledge_store
+from rwlock import RWLock
+
+# 等待另一个线程进入阻塞状态的时间
+SETTLE = 0.05
+TIMEOUT = 5
+
+
+def start(target):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_readers_share_the_lock():
+    lock = RWLock()
+    inside = threading.Barrier(3, timeout=TIMEOUT)
+
+    def reader():
+        with lock.read():
+            # 三个读者都进入后才能通过屏障，读锁互斥时会超时
+            inside.wait()
+
+    threads = [start(reader) for _ in range(3)]
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_writer_excludes_readers():
+    lock = RWLock()
+    events = []
+    lock.acquire_write()
+    reader = start(lambda: (lock.acquire_read(), events.append("read"), lock.release_read()))
+    time.sleep(SETTLE)
+    assert events == []
+    events.append("write done")
+    lock.release_write()
+    reader.join(TIMEOUT)
+    assert events == ["write done", "read"]
+
+
+def test_waiting_writer_blocks_new_readers():
+    lock = RWLock()
+    events = []
+    lock.acquire_read()
+    writer = start(lambda: (lock.acquire_write(), events.append("write"), lock.release_write()))
+    time.sleep(SETTLE)
+    reader = start(lambda: (lock.acquire_read(), events.append("read"), lock.release_read()))
+    time.sleep(SETTLE)
+    # 写者在等待，新的读者不能插队
+    assert events == []
+    lock.release_read()
+    writer.join(TIMEOUT)
+    reader.join(TIMEOUT)
+    assert events == ["write", "read"]
+
+
+def test_reentrant_read_does_not_deadlock_with_waiting_writer():
+    lock = RWLock()
+    writer_waiting = threading.Event()
+    events = []
+
+    def reader():
+        with lock.read():
+            writer_waiting.wait(TIMEOUT)
+            time.sleep(SETTLE)
+            # 已经持有读锁的线程再次获取读锁立即成功，不等待排队的写者
+            with lock.read():
+                events.append("reentered")
+
+    def writer():
+        writer_waiting.set()
+        with lock.write():
+            events.append("write")
+
+    threads = [start(reader)]
+    time.sleep(SETTLE)
+    threads.append(start(writer))
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert not any(thread.is_alive() for thread in threads)
+    assert events == ["reentered", "write"]
+
+
+def test_write_lock_is_reentrant_and_allows_reading():
+    lock = RWLock()
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                pass
+    # 完全释放后其他线程可以获取写锁
+    other = start(lambda: (lock.acquire_write(), lock.release_write()))
+    other.join(TIMEOUT)
+    assert not other.is_alive()
+
+
+def test_upgrade_raises_instead_of_deadlocking():
+    lock = RWLock()
+    with lock.read():
+        with pytest.raises(RuntimeError):
+            lock.acquire_write()
+    # 失败的升级不会留下等待中的写者
+    with lock.write():
+        pass
+
+
+def test_release_write_by_other_thread_raises():
+    lock = RWLock()
+    errors = []
+
+    def release():
+        try:
+            lock.release_write()
+        except RuntimeError as e:
+            errors.append(e)
+
+    with lock.write():
+        start(release).join(TIMEOUT)
+    assert len(errors) == 1
+
+
+def test_file_lock_is_shared_per_absolute_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "a.json"
+    assert knowledge_store.file_lock(str(path)) is knowledge_store.file_lock("a.json")
+    assert knowledge_store.file_lock(str(path)) is not knowledge_store.file_lock(str(tmp_path / "b.json"))
+
+
+def test_concurrent_appends_keep_every_item(tmp_path):
+    path = str(tmp_path / "sub.json")
+    knowledge_store.write_sub_knowledge_file(path, "summary", [])
+    writers, per_writer = 4, 5
+
+    def append(writer):
+        rng = np.random.default_rng(writer)
+        for i in range(per_writer):
+            knowledge_store.append_sub_knowledge(
+                path, [{"text": f"{writer}-{i}", "embedding": rng.normal(size=8).tolist()}])
+
+    threads = [start(lambda w=w: append(w)) for w in range(writers)]
+    loaded = []
+    while any(thread.is_alive() for thread in threads):
+        # 读者在写入过程中加载，文本条数和嵌入行数总是一致
+        sub_knowledges = knowledge_store.load_sub_knowledge_file(path)
+        loaded.append(len(sub_knowledges.items) == len(sub_knowledges.index))
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    sub_knowledges = knowledge_store.load_sub_knowledge_file(path)
+    assert sorted(item["text"] for item in sub_knowledges.items) == sorted(
+        f"{w}-{i}" for w in range(writers) for i in range(per_writer))
+    assert len(sub_knowledges.index) == writers * per_writer
+    assert all(loaded)
@@ -0,0 +1,187 @@
+import threading
+from collections import deque
+import numpy as np
+import apis
+from vector_index import VectorIndex
+
+# margin（第一名与第二名原型的余弦相似度之差）阈值的下限。实际阈值由留出的LLM决策校准，不会低于该值
+TRANSITION_MARGIN = 0.02
+# 预测出的状态至少有这么多条已记录的样本时才可能采用分类结果，只有状态名称的原型在嵌入空间中区分度太低
+MIN_SAMPLES_PER_LABEL = 5
+# 校准阈值时要求的准确率：margin 不低于阈值的留出预测中，与LLM结果一致的比例至少为该值
+TARGET_ACCURACY = 0.9
+# 至少积累这么多条留出预测后才校准阈值，在此之前总是交给LLM判断
+MIN_CALIBRATION_SAMPLES = 30
+# 校准出的阈值之上至少要有这么多条留出预测，避免由少数几条样本决定阈值
+CALIBRATION_SUPPORT = 10
+# 最多保留的留出预测条数，较旧的被丢弃，使阈值跟随原型的变化
+MAX_CALIBRATION_SAMPLES = 500
+# 每个原型中状态名称本身的嵌入向量相当于多少个已记录样本的权重
+LABEL_PRIOR_WEIGHT = 2.0
+
+
+class TransitionClassifier:
+    """
+    TransitionClassifier 类是一个基于嵌入向量的本地状态分类器，用于在不调用LLM的情况下决定 FSM 的状态转移。
+
+    每个状态有一个原型向量：状态名称（按 label_template 格式化后）的嵌入向量，加上已记录的、转移到该状态的
+    “当前状态+事件+想法”嵌入向量的均值，两者按 LABEL_PRIOR_WEIGHT 加权。分类时计算查询向量与各原型的余弦相似度，
+    第一名领先第二名的幅度（margin）记为分类的把握。
+
+    分类结果默认不可信，总是交给LLM：每次记录LLM的决策之前，先用当前的原型对它做一次预测，作为留出的校准样本。
+    留出样本足够多后，取能使 margin 不低于阈值的预测达到 TARGET_ACCURACY 准确率的最小阈值；只有 margin 达到该阈值、
+    且预测出的状态已有 MIN_SAMPLES_PER_LABEL 条样本时才采用分类结果。
+
+    方法:
+    - predict(query_embedding): 返回 (最可能的状态, margin)。
+    - trusts(label, margin): 判断一次预测是否可以代替LLM。
+    - threshold(): 返回校准出的 margin 阈值，尚未校准时返回 None。
+    - classify(query_embedding): 预测可信时返回状态，否则返回 None。
+    - record(query_embedding, label): 记录一次已确认的状态转移（先作为留出样本校准阈值），用于更新原型。
+    - fit(embeddings, labels): 用一批已记录的状态转移拟合原型。
+    - save(path) / load(path): 把已记录的样本和留出样本保存到 .npz 文件或从中加载。
+    """
+    def __init__(self, labels, label_template="{}", margin=TRANSITION_MARGIN, prior_weight=LABEL_PRIOR_WEIGHT,
+                 min_samples=MIN_SAMPLES_PER_LABEL, target_accuracy=TARGET_ACCURACY,
+                 min_calibration_samples=MIN_CALIBRATION_SAMPLES):
+        self.labels = list(labels)
+        self.label_template = label_template
+        self.margin = margin
+        self.prior_weight = prior_weight
+        self.min_samples = min_samples
+        self.target_accuracy = target_accuracy
+        self.min_calibration_samples = min_calibration_samples
+        self._label_embeddings = None
+        self._sums = {}
+        self._counts = {}
+        self._index = None
+        # 留出样本：(margin, 预测是否与LLM一致)
+        self._calibration = deque(maxlen=MAX_CALIBRATION_SAMPLES)
+        self._threshold = None
+        self._lock = threading.Lock()
+
+    def _ensure_label_embeddings(self):
+        """第一次使用时批量获取所有状态名称的嵌入向量（经过嵌入缓存，之后的进程不再请求接口）。"""
+        if self._label_embeddings is None:
+            embeddings = apis.request_embedding([self.label_template.format(label) for label in self.labels],
+                                                priority=apis.PRIORITY_BACKGROUND)
+            if not embeddings or len(embeddings) != len(self.labels):
+                return False
+            self._label_embeddings = VectorIndex(embeddings).matrix.copy()
+            self._index = None
+        return True
+
+    def _prototypes(self):
+        if self._index is None:
+            prototypes = self.prior_weight * self._label_embeddings
+            for i, label in enumerate(self.labels):
+                if self._counts.get(label):
+                    prototypes[i] += self._sums[label] / np.linalg.norm(self._sums[label]) * self._counts[label]
+            self._index = VectorIndex(prototypes)
+        return self._index
+
+    def predict(self, query_embedding):
+        """
+        返回与查询向量最接近的状态。
+
+        参数:
+        query_embedding: “当前状态+事件+想法”的嵌入向量。
+
+        返回:
+        tuple: (状态, margin)。无法分类（例如嵌入接口失败）时返回 (None, 0.0)。
+        """
+        if query_embedding is None or not self.labels:
+            return None, 0.0
+        with self._lock:
+            if not self._ensure_label_embeddings():
+                return None, 0.0
+            index = self._prototypes()
+        indices, scores = index.search(query_embedding, 2)
+        if not len(indices):
+            return None, 0.0
+        margin = float(scores[0] - scores[1]) if len(scores) > 1 else 1.0
+        return self.labels[indices[0]], margin
+
+    def _calibrate(self):
+        """根据留出样本重新计算阈值。调用者持有锁。"""
+        self._threshold = None
+        if len(self._calibration) < self.min_calibration_samples:
+            return
+        # 按 margin 从大到小累计准确率，取满足目标准确率的最小 margin
+        correct = 0
+        for count, (margin, hit) in enumerate(sorted(self._calibration, reverse=True), 1):
+            correct += hit
+            if count >= CALIBRATION_SUPPORT and correct / count >= self.target_accuracy:
+                self._threshold = max(self.margin, margin)
+
+    def threshold(self):
+        """返回校准出的 margin 阈值；留出样本不足或达不到目标准确率时返回 None（总是交给LLM）。"""
+        with self._lock:
+            return self._threshold
+
+    def trusts(self, label, margin):
+        """判断一次预测是否可以代替LLM：阈值已校准、margin 达到阈值，且预测出的状态有足够的已记录样本。"""
+        with self._lock:
+            return (label is not None and self._threshold is not None and margin >= self._threshold
+                    and self._counts.get(label, 0) >= self.min_samples)
+
+    def classify(self, query_embedding):
+        """预测可信时返回分类出的状态，否则返回 None。"""
+        label, margin = self.predict(query_embedding)
+        return label if self.trusts(label, margin) else None
+
+    def record(self, query_embedding, label):
+        """
+        记录一次已确认的状态转移（例如LLM给出的合法结果），把查询向量计入该状态的原型。
+        计入之前先用当前的原型预测一次，预测出的状态样本足够时把 (margin, 是否一致) 作为留出样本校准阈值。
+
+        参数:
+        query_embedding: “当前状态+事件+想法”的嵌入向量。
+        label: 转移到的状态，不在状态列表中时忽略。
+        """
+        if query_embedding is None or label not in self.labels:
+            return
+        vector = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return
+        predicted, margin = self.predict(vector)
+        with self._lock:
+            if predicted is not None and self._counts.get(predicted, 0) >= self.min_samples:
+                self._calibration.append((margin, predicted == label))
+                self._calibrate()
+            self._sums[label] = self._sums.get(label, 0) + vector / norm
+            self._counts[label] = self._counts.get(label, 0) + 1
+            self._index = None
+
+    def fit(self, embeddings, labels):
+        """用一批已记录的状态转移拟合原型。"""
+        for embedding, label in zip(embeddings, labels):
+            self.record(embedding, label)
+
+    def save(self, path):
+        """把已记录的样本（每个状态的向量和与计数）和留出样本保存到 .npz 文件。"""
+        with self._lock:
+            recorded = [label for label in self.labels if self._counts.get(label)]
+            with open(path, 'wb') as file:
+                np.savez(file,
+                         labels=np.array(recorded),
+                         sums=np.array([self._sums[label] for label in recorded]),
+                         counts=np.array([self._counts[label] for label in recorded]),
+                         calibration_margins=np.array([margin for margin, _ in self._calibration], dtype=np.float64),
+                         calibration_hits=np.array([hit for _, hit in self._calibration], dtype=bool))
+
+    def load(self, path):
+        """从 .npz 文件加载已记录的样本和留出样本，不在当前状态列表中的状态被忽略。"""
+        with np.load(path) as data:
+            with self._lock:
+                for label, vector_sum, count in zip(data["labels"].tolist(), data["sums"], data["counts"]):
+                    if label in self.labels:
+                        self._sums[label] = vector_sum
+                        self._counts[label] = int(count)
+                self._index = None
+                # 旧版本的文件没有留出样本，阈值重新从LLM决策中校准
+                if "calibration_margins" in data.files:
+                    self._calibration.extend(zip(data["calibration_margins"].tolist(),
+                                                 data["calibration_hits"].tolist()))
+                self._calibrate()
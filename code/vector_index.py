@@ -0,0 +1,270 @@
+import numpy as np
+
+# 可选的量化存储格式
+QUANTIZATIONS = (None, "int8", "float16")
+# 量化检索时先按量化相似度取 top_k * RESCORE_FACTOR 个候选，再用全精度向量重新打分
+RESCORE_FACTOR = 4
+# 量化矩阵反量化计算相似度时每次处理的行数。分块较小时转换缓冲区留在CPU缓存中，int8 的检索速度接近 float32
+SCORE_CHUNK_SIZE = 1024
+
+
+class VectorIndex:
+    """
+    VectorIndex 类把一组嵌入向量保存在一个预先归一化的 NumPy 矩阵中，用于批量的余弦相似度检索。
+
+    矩阵的第 i 行与外部列表（例如记忆流）的第 i 个元素一一对应，调用者需要在增删元素时同步调用
+    append()/delete()/clear()。矩阵按容量倍增的方式预留空间，追加操作是均摊 O(1) 的。
+
+    quantization 为 "int8" 或 "float16" 时，矩阵以量化形式保存（int8 每行带一个缩放因子），
+    内存占用分别为 float32 的 1/4 和 1/2。检索时先用量化相似度选出候选，如果设置了 exact_rows
+    （按行号返回全精度向量的函数，例如从记忆流或内存映射的嵌入段中取），再对候选用全精度重新打分。
+
+    方法:
+    - rebuild(embeddings): 用一组嵌入向量重建整个矩阵。
+    - append(embedding): 在末尾追加一个嵌入向量。
+    - delete(index): 删除指定行，后面的行依次前移。
+    - clear(): 清空矩阵。
+    - scores(query_embedding): 计算查询向量与所有行的余弦相似度（量化时为近似值）。
+    - search(query_embedding, top_k): 返回相似度最高的 top_k 行的索引和相似度。
+    - nbytes(): 矩阵（含缩放因子）实际占用的字节数。
+    """
+    def __init__(self, embeddings=None, dtype=np.float32, quantization=None, exact_rows=None):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"不支持的量化格式：{quantization}，可选：{QUANTIZATIONS}")
+        self.dtype = dtype
+        self.quantization = quantization
+        self.exact_rows = exact_rows
+        self.dim = None
+        self._matrix = None
+        self._scales = None
+        self._size = 0
+        if embeddings is not None and len(embeddings):
+            self.rebuild(embeddings)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def _storage_dtype(self):
+        if self.quantization == "int8":
+            return np.int8
+        if self.quantization == "float16":
+            return np.float16
+        return self.dtype
+
+    @property
+    def matrix(self):
+        """当前有效的归一化矩阵（不含预留的空行）。量化时返回反量化后的 float32 副本。"""
+        if self._matrix is None:
+            return np.empty((0, self.dim or 0), dtype=self.dtype)
+        if self.quantization is None:
+            return self._matrix[:self._size]
+        return self._dequantize(0, self._size)
+
+    def nbytes(self):
+        """矩阵（含缩放因子）实际占用的字节数。"""
+        if self._matrix is None:
+            return 0
+        return self._matrix.nbytes + (self._scales.nbytes if self._scales is not None else 0)
+
+    def _normalize(self, vectors):
+        """按行归一化，零向量保持为零，避免除零。"""
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _quantize(self, rows):
+        """把归一化的行转换为存储格式，返回 (codes, scales)。int8 使用每行的对称缩放因子。"""
+        if self.quantization == "int8":
+            scales = np.abs(rows).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            codes = np.round(rows / scales[:, None]).astype(np.int8)
+            return codes, scales.astype(np.float32)
+        return rows.astype(self._storage_dtype), None
+
+    def _dequantize(self, start, stop):
+        rows = self._matrix[start:stop].astype(np.float32)
+        if self._scales is not None:
+            rows *= self._scales[start:stop, None]
+        return rows
+
+    def _store(self, start, rows):
+        """把归一化的行写入 [start, start + len(rows)) 位置。"""
+        codes, scales = self._quantize(rows)
+        self._matrix[start:start + len(rows)] = codes
+        if self._scales is not None:
+            self._scales[start:start + len(rows)] = scales
+
+    def _reserve(self, capacity):
+        """保证矩阵至少能容纳 capacity 行。"""
+        if self._matrix is not None and self._matrix.shape[0] >= capacity:
+            return
+        new_capacity = max(capacity, 16, 0 if self._matrix is None else self._matrix.shape[0] * 2)
+        new_matrix = np.zeros((new_capacity, self.dim), dtype=self._storage_dtype)
+        new_scales = np.ones(new_capacity, dtype=np.float32) if self.quantization == "int8" else None
+        if self._matrix is not None:
+            new_matrix[:self._size] = self._matrix[:self._size]
+            if new_scales is not None:
+                new_scales[:self._size] = self._scales[:self._size]
+        self._matrix = new_matrix
+        self._scales = new_scales
+
+    def _row(self, embedding):
+        """把单个嵌入向量转换为归一化的行；维度不一致或为空时返回零行。"""
+        if embedding is None or len(embedding) == 0:
+            return np.zeros(self.dim, dtype=self.dtype) if self.dim else None
+        if self.dim is None:
+            self.dim = len(embedding)
+        if len(embedding) != self.dim:
+            return np.zeros(self.dim, dtype=self.dtype)
+        return self._normalize(embedding)[0]
+
+    def rebuild(self, embeddings):
+        """
+        用一组嵌入向量重建整个矩阵。
+
+        参数:
+        embeddings: 嵌入向量的列表或二维矩阵，顺序与外部列表一致。空向量或维度不一致的向量会以零行占位。
+        """
+        self._matrix = None
+        self._scales = None
+        self._size = 0
+        if isinstance(embeddings, np.ndarray) and embeddings.ndim == 2:
+            # 已经是矩阵（例如内存映射的嵌入段），直接整体归一化
+            self.dim = embeddings.shape[1]
+            self._reserve(embeddings.shape[0])
+            self._store(0, self._normalize(embeddings))
+            self._size = embeddings.shape[0]
+            return
+        self.dim = next((len(e) for e in embeddings if e is not None and len(e) > 0), None)
+        if self.dim is None:
+            # 没有任何有效向量，仅记录行数，保证与外部列表对齐
+            self._size = len(embeddings)
+            return
+
+        rows = np.zeros((len(embeddings), self.dim), dtype=self.dtype)
+        for i, embedding in enumerate(embeddings):
+            if embedding is not None and len(embedding) == self.dim:
+                rows[i] = embedding
+        self._reserve(len(embeddings))
+        self._store(0, self._normalize(rows))
+        self._size = len(embeddings)
+
+    def append(self, embedding):
+        """在矩阵末尾追加一个嵌入向量。"""
+        row = self._row(embedding)
+        if row is None:
+            # 维度尚未确定，仅记录占位行
+            self._size += 1
+            return
+        # 新分配的矩阵以零填充，之前的占位行自然成为零行
+        self._reserve(self._size + 1)
+        self._store(self._size, row.reshape(1, -1))
+        self._size += 1
+
+    def delete(self, index):
+        """删除第 index 行，后面的行原地前移。"""
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("VectorIndex 索引超出范围")
+        if self._matrix is not None:
+            self._matrix[index:self._size - 1] = self._matrix[index + 1:self._size]
+            if self._scales is not None:
+                self._scales[index:self._size - 1] = self._scales[index + 1:self._size]
+        self._size -= 1
+
+    def clear(self):
+        """清空矩阵，保留已分配的空间。"""
+        self._size = 0
+
+    def _query(self, query_embedding):
+        """把查询向量归一化；无效时返回 None。"""
+        query = np.asarray(query_embedding, dtype=self.dtype)
+        if query.shape != (self.dim,):
+            return None
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return None
+        return query / norm
+
+    def scores(self, query_embedding):
+        """
+        计算查询向量与所有行的余弦相似度。
+
+        参数:
+        query_embedding: 查询向量。
+
+        返回:
+        np.ndarray: 长度为 len(self) 的相似度数组，量化时为近似值。查询向量无效时返回全零数组。
+        """
+        if self._matrix is None or not self._size:
+            return np.zeros(self._size, dtype=self.dtype)
+        query = self._query(query_embedding)
+        if query is None:
+            return np.zeros(self._size, dtype=self.dtype)
+        if self.quantization is None:
+            return self._matrix[:self._size] @ query
+
+        scores = np.empty(self._size, dtype=np.float32)
+        query = query.astype(np.float32)
+        buffer = np.empty((min(SCORE_CHUNK_SIZE, self._size), self.dim), dtype=np.float32)
+        for start in range(0, self._size, SCORE_CHUNK_SIZE):
+            stop = min(start + SCORE_CHUNK_SIZE, self._size)
+            rows = buffer[:stop - start]
+            np.copyto(rows, self._matrix[start:stop], casting="unsafe")
+            scores[start:stop] = rows @ query
+            if self._scales is not None:
+                scores[start:stop] *= self._scales[start:stop]
+        return scores
+
+    def _rescore(self, query_embedding, candidates):
+        """用全精度向量重新计算候选行的相似度。"""
+        query = self._query(query_embedding)
+        rows = np.asarray(self.exact_rows(candidates), dtype=self.dtype).reshape(len(candidates), self.dim)
+        return self._normalize(rows) @ query
+
+    def search(self, query_embedding, top_k=1):
+        """
+        返回与查询向量最相似的 top_k 行。量化且设置了 exact_rows 时，先按量化相似度取
+        top_k * RESCORE_FACTOR 个候选，再用全精度相似度重新排序。
+
+        参数:
+        query_embedding: 查询向量。
+        top_k: 返回的结果数量。
+
+        返回:
+        tuple: (indices, similarities)，均按相似度从高到低排序。
+        """
+        scores = self.scores(query_embedding)
+        if self.quantization is None or self.exact_rows is None or self._query(query_embedding) is None:
+            return top_k_indices(scores, top_k)
+
+        candidates, _ = top_k_indices(scores, top_k * RESCORE_FACTOR)
+        if not len(candidates):
+            return candidates, scores[candidates]
+        exact = self._rescore(query_embedding, candidates)
+        order, exact = top_k_indices(exact, top_k)
+        return candidates[order], exact
+
+
+def top_k_indices(scores, top_k):
+    """
+    使用 argpartition 从相似度数组中取出最高的 top_k 项，并按相似度降序排列。
+
+    返回:
+    tuple: (indices, similarities)
+    """
+    n = len(scores)
+    if n == 0 or top_k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    top_k = min(top_k, n)
+    if top_k < n:
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(n)
+    order = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return order, scores[order]
@@ -1,11 +1,21 @@
 import gradio as gr
 import json
+import os
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import apis
 from perception import Perception
 from action import Action
 from brain import Brain
+from memory_consolidator import MemoryConsolidator
+from session_manager import SessionManager
 from lucy_agent import LucyAgent
 
+# 同时执行的事件处理函数数量。Brain 的检索持有读锁可以并行，修改持有写锁串行执行
+HANDLER_CONCURRENCY = 16
+# 为 True 时丢弃保存的快照和日志，从初始化文件重新开始
+RESET_BRAIN = os.environ.get("LUCY_RESET_BRAIN") == "1"
+
 # 简单的事件模拟，本来应该在沙盒环境里面去定义。沙盒环境相关工程量太大了，暂时没做。
 PERCEPTION_LIST = [
     "胡桃听到了hadi在打招呼。",
@@ -19,9 +29,44 @@ with open("../resource/hutao.json", "r", encoding="utf-8") as json_file:
 
 perception = Perception()
 action = Action()
-brain = Brain.from_json(loaded_data)
+# 记忆和知识的增删以追加日志的方式持久化到 “中文name.json” 快照和它的日志中，并在后台压缩进快照，不影响用来初始化的文件。
+# 快照存在时从快照和日志恢复上次运行的状态，只有第一次运行或设置了 LUCY_RESET_BRAIN=1 时才从初始化文件开始。
+# 快照和日志与 api_server 共用，另一个进程正在使用时抛出 JournalInUseError，拒绝启动。
+brain = Brain.load_persisted(loaded_data, reset=RESET_BRAIN)
+# 知识规模较大时使用近似索引。索引随知识的增删保存；不存在或与知识库不一致时在后台重新建立，建立完成前使用精确搜索
+brain.ensure_ann_index()
+# 嵌入矩阵在后台构建，不阻塞界面启动
+brain.warm_up()
+# 思考内容和回复在一次LLM调用中生成，流式展示时只推送回复部分
+brain.cot_single_call = True
+# 记忆达到上限后由后台线程聚类总结，不占用回合后的记账线程
+memory_consolidator = MemoryConsolidator(brain)
+memory_consolidator.start()
 hutao = LucyAgent(perception, brain, action)
 
+# 本地转移分类器记录的LLM转移结果，跨进程保留，分类器越用越少地回退到LLM
+TRANSITION_CLASSIFIER_PATHS = {
+    "mood_classifier": f"../resource/{brain.name}_mood_transitions.npz",
+    "action_state_classifier": f"../resource/{brain.name}_action_state_transitions.npz",
+}
+for attribute, path in TRANSITION_CLASSIFIER_PATHS.items():
+    classifier = getattr(brain.fsm, attribute)
+    if classifier is not None and os.path.exists(path):
+        classifier.load(path)
+
+# 每个 Gradio 会话有自己的会话大脑（记忆流、心情、行动状态、对话上下文），共享上面 brain 的知识库和知识索引。
+# 知识的管理仍然通过 brain 进行。空闲的会话按LRU换出到 ../resource/sessions/。
+# 回合后的记账（创建记忆、状态转移）在各个会话自己的单线程队列中执行，不阻塞回复的展示，同一会话的回合严格按顺序执行。
+session_manager = SessionManager(brain)
+# 会话大脑没有日志，每个回合后保存一次；退出时（包括异常退出）保存所有会话
+atexit.register(session_manager.close)
+# 转移分类器的样本由所有会话共享，保存任务只需要一个工作线程
+classifier_save_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classifier_save")
+
+def get_session_id(request):
+    # 没有会话信息时（例如直接调用）所有请求共用一个会话
+    return getattr(request, "session_hash", None) or "default"
+
 def save_to_file(file_path:str, conversations)-> None:
     with open(file_path, 'w', encoding='utf-8') as f:
         json.dump(conversations, f, ensure_ascii=False, indent=4)
@@ -31,47 +76,87 @@ def load_prompts(json_file: str) -> dict:
         data = json.load(f)
     return {item['key']: item['prompt'] for item in data}
 
-def save_agent_json(agent_brain):
-    # 默认存到 “中文name.json” 当中，不影响用来初始化的文件
-    name = agent_brain.name
-    file_path = f"../resource/{name}.json"
+def save_transition_classifiers():
+    # 后台任务：保存转移分类器记录的样本
+    try:
+        for attribute, path in TRANSITION_CLASSIFIER_PATHS.items():
+            classifier = getattr(brain.fsm, attribute)
+            if classifier is not None:
+                classifier.save(path)
+    except Exception as e:
+        print(f"保存转移分类器时发生错误：{e}")
+
+def remember_and_transit(session_brain, perception_text, output_text, thought, kinds):
+    # 后台任务：一次合并调用创建记忆并加入会话的记忆流（可能触发记忆总结），同时进行状态转移
+    try:
+        session_brain.update_state_after_turn(perception_text, output_text, thought, kinds)
+    except Exception as e:
+        print(f"回合后的记账发生错误：{e}")
+    classifier_save_executor.submit(save_transition_classifiers)
+
+def transit_action_state(session_brain, perception_text, output_text, thought):
+    # 合并调用校验后立即设置新的行动状态，返回合并调用生成的记忆总结；失败时行动状态不变
     try:
-        with open(file_path, "w", encoding="utf-8") as json_file:
-            json.dump(agent_brain.to_json(), json_file, indent=4, ensure_ascii=False)
-    except IOError:
-        print("无法写入文件。")
+        summary = session_brain.transit_after_turn(perception_text, output_text, thought, ("action_state",))
+    except Exception as e:
+        print(f"行动状态转移发生错误：{e}")
+        return None
+    classifier_save_executor.submit(save_transition_classifiers)
+    return summary
+
+def remember(session_brain, perception_text, output_text, summary):
+    # 后台任务：用记忆总结创建记忆（请求嵌入向量）并加入会话的记忆流
+    try:
+        session_brain.remember_after_turn(perception_text, output_text, summary)
+    except Exception as e:
+        print(f"回合后的记账发生错误：{e}")
+
+def remember_and_transit_mood(session_brain, perception_text, output_text, thought):
+    # 后台任务：创建记忆并进行心情转移，返回新心情对应的表情
+    remember_and_transit(session_brain, perception_text, output_text, thought, ("mood",))
+    return session_brain.fsm.get_current_emoji()
 
-def perceive_and_change_action(trigger):
+def perceive_and_change_action(trigger, request: gr.Request):
     if not trigger:
         return "下拉菜单为空或没有接收到下拉菜单的值", "../resource/pictures/hutao_naohuo.webp"
 
-    old_action_state = hutao.brain.fsm.action_state
-    thought = hutao.brain.create_thought_from_perception(trigger)
-    hutao.brain.fsm.action_state_transition(trigger, thought)
-    action_state_str, scene_path = show_action_state()
-    action_state_str = (f"胡桃原先正在{old_action_state},因为{trigger}胡桃认为:{thought}"
-                        f"\n\n因而决定{hutao.brain.fsm.action_state}")
-
-    memory = hutao.brain.create_memory(trigger, f"胡桃进行了思考：{thought}")
-    hutao.brain.add_memory(memory)
-    save_agent_json(hutao.brain)
+    with session_manager.session(get_session_id(request)) as session:
+        session_brain = session.brain
+        old_action_state = session_brain.fsm.action_state
+        thought = session_brain.create_thought_from_perception(trigger)
+        output_text = f"胡桃进行了思考：{thought}"
+        # 记忆总结和行动状态在一次合并调用中生成。只等待合并调用，新的行动状态校验后立即展示；
+        # 回合后的记账队列只处理心情，行动状态不会与之冲突。记忆的嵌入请求和加入记忆流放进记账队列，不等待
+        summary = transit_action_state(session_brain, trigger, output_text, thought)
+        session.submit(remember, session_brain, trigger, output_text, summary)
+        action_state_str, scene_path = action_state_scene(session_brain)
+        action_state_str = (f"胡桃原先正在{old_action_state},因为{trigger}胡桃认为:{thought}"
+                            f"\n\n因而决定{session_brain.fsm.action_state}")
 
     print(action_state_str)
     return action_state_str, scene_path
 
-def show_action_state():
+def action_state_scene(session_brain):
     scene_path = "../resource/pictures/hutao_xiuxi.webp"
-    if hutao.brain.fsm.action_state == "休息":
+    if session_brain.fsm.action_state == "休息":
         scene_path = "../resource/pictures/hutao_xiuxi.webp"
-    if hutao.brain.fsm.action_state == "看璃月的历史书":
+    if session_brain.fsm.action_state == "看璃月的历史书":
         scene_path = "../resource/pictures/hutao_kanshu.webp"
-    if hutao.brain.fsm.action_state == "策划往生堂的特别活动":
+    if session_brain.fsm.action_state == "策划往生堂的特别活动":
         scene_path = "../resource/pictures/hutao_cehua.jfif"
-    if hutao.brain.fsm.action_state == "做咖啡并递交给客户":
+    if session_brain.fsm.action_state == "做咖啡并递交给客户":
         scene_path = "../resource/pictures/hutao_coffee.webp"
-    if hutao.brain.fsm.action_state == "回复问题和聊天":
+    if session_brain.fsm.action_state == "回复问题和聊天":
         scene_path = "../resource/pictures/hutao_yao.webp"
-    return f"胡桃正在{hutao.brain.fsm.action_state}", scene_path
+    return f"胡桃正在{session_brain.fsm.action_state}", scene_path
+
+def show_action_state(request: gr.Request):
+    with session_manager.session(get_session_id(request)) as session:
+        return action_state_scene(session.brain)
+
+def show_info(request: gr.Request):
+    with session_manager.session(get_session_id(request)) as session:
+        return session.brain.show_info()
 
 
 def user(query, gr_states, history):
@@ -81,58 +166,75 @@ def user(query, gr_states, history):
     return "", gr_states, history
     
 
-def bot(gr_states, history):
+def bot(gr_states, history, request: gr.Request):
+    with session_manager.session(get_session_id(request)) as session:
+        yield from session_bot(session, gr_states, history)
+
+
+def session_bot(session, gr_states, history):
+    session_brain = session.brain
     query = history[-1][0]
-    if hutao.brain.fsm.action_state != "回复问题和聊天":
-        action_state_str, scene_path = show_action_state()
+    if session_brain.fsm.action_state != "回复问题和聊天":
+        action_state_str, scene_path = action_state_scene(session_brain)
         gr_states[-1][1] = action_state_str
         history[-1][1] = action_state_str
         print(f"gr_states, history:{gr_states, history}")
-        return gr_states, history, scene_path
+        yield gr_states, history, scene_path
+        return
     
     if not query:
         gr_states[-1][1] = "请不要不说话嘞"
         history[-1][1] = "请不要不说话嘞"
         print(f"gr_states, history:{gr_states, history}")
-        return gr_states, history, "../resource/pictures/hutao_naohuo.webp"
-
-    response, _, thought = hutao.brain.cot_chat(query, history)
-    gr_states[-1][1] = response
-    history[-1][-1] = response
-
+        yield gr_states, history, "../resource/pictures/hutao_naohuo.webp"
+        return
+
+    # 回复逐段推送给用户，表情包保持不变
+    response, thought = None, ""
+    for response, _, thought in session_brain.cot_chat_stream(query, history):
+        gr_states[-1][1] = response
+        history[-1][-1] = response
+        yield gr_states, history, gr.update()
+    # 会话被换出后再恢复时，对话历史随会话一起恢复
+    session.history = history
+
+    # 回复完整后，记忆和心情的更新在会话的记账队列中按顺序执行
     input = f"胡桃收到了来自hadi的询问：{query}"
     output = f"进行了思考：{thought},做出了回复：{response}"
-    memory = hutao.brain.create_memory(input,output)
-    hutao.brain.add_memory(memory)
-
-    # 获取心情驱动的表情包
-    hutao.brain.fsm.mood_transition(input, thought)
-    image_path = hutao.brain.fsm.get_current_emoji()
-
-    save_agent_json(hutao.brain)
+    emoji_future = session.submit(remember_and_transit_mood, session_brain, input, output, thought)
     print(f"gr_states, history:{gr_states, history}")
-    return gr_states, history, image_path
+
+    # 心情转移完成后只更新心情驱动的表情包
+    image_path = emoji_future.result()
+    yield gr_states, history, image_path
 
 
-def del_memory(memory_index):
-    memory_str = ""
-    if isinstance(memory_index, int):
-        memory_str = hutao.brain.del_memory(mode="single", index=memory_index)
-        save_agent_json(hutao.brain)
-    if not memory_index:
-        memory_str = "下拉菜单为空或没有接收到下拉菜单的值"
+def del_memory(memory_index, request: gr.Request):
+    with session_manager.session(get_session_id(request)) as session:
+        memory_str = ""
+        if isinstance(memory_index, int):
+            # 在记账队列中执行，与回合后的记忆更新保持顺序，完成后会话被保存
+            memory_str = session.submit(session.brain.del_memory, mode="single", index=memory_index).result()
+        if not memory_index:
+            memory_str = "下拉菜单为空或没有接收到下拉菜单的值"
 
-    memory_keys = list(range(len(hutao.brain.memory_stream)))
+        memory_keys = list(range(len(session.brain.memory_stream)))
     memory_dropdown = gr.Dropdown(memory_keys, label="要删除的记忆序号\U0001F600")
 
     return memory_str, memory_dropdown
 
 
+def load_memory_dropdown(request: gr.Request):
+    # 记忆序号属于当前会话的会话大脑，页面加载时才能确定会话
+    with session_manager.session(get_session_id(request)) as session:
+        memory_keys = list(range(len(session.brain.memory_stream)))
+    return gr.Dropdown(memory_keys, label="要删除的记忆序号\U0001F600")
+
+
 def del_knowledge(knowledge_index):
     knowledge_str = ""
     if isinstance(knowledge_index, int):
         knowledge_str = hutao.brain.del_knowledge(mode="single", index=knowledge_index)
-        save_agent_json(hutao.brain)
     if not knowledge_str:
         knowledge_str = "下拉菜单为空或没有接收到下拉菜单的值"
 
@@ -162,13 +264,11 @@ def split_text_and_add_to_knowledge(content, summary_text):
                                 f"嵌入向量大小:{len(knowledge['embedding'])}\n"
                                 f"子知识文件路径：{knowledge['sub_knowledge']}\n"
                                 f"{'-' * 40}\n")
-        save_agent_json(hutao.brain)
 
         return knowledge_str, split
 
     else:
         knowledge = hutao.brain.add_knowledge_from_text(content)
-        save_agent_json(hutao.brain)
         knowledge_str = (f"知识描述:\n{knowledge['text']}\n"
                             f"嵌入向量大小:{len(knowledge['embedding'])}\n"
                             f"由于输入的知识文本较短，没有发生切分或产生子知识文件\n"
@@ -230,11 +330,11 @@ if __name__ == "__main__":
                 with gr.Column():
                     agent_state = gr.Textbox(lines=25, max_lines=25, label="胡桃的Brain模块状态\U0001F4C4")
                     button = gr.Button("查询 \U0001F600")
-                    button.click(hutao.brain.show_info, inputs=[], outputs=agent_state)
+                    button.click(show_info, inputs=[], outputs=agent_state)
 
                 with gr.Column():
-                    memory_keys = list(range(len(hutao.brain.memory_stream)))
-                    memory_dropdown = gr.Dropdown(memory_keys, label="要删除的记忆序号\U0001F600")
+                    memory_dropdown = gr.Dropdown([], label="要删除的记忆序号\U0001F600")
+                    demo.load(load_memory_dropdown, inputs=[], outputs=memory_dropdown)
                     memory_deleted = gr.Textbox(label="已删除的胡桃记忆🧠")
                     button = gr.Button("删除记忆🧊")
                     button.click(fn=del_memory,
@@ -377,4 +477,5 @@ if __name__ == "__main__":
                                  gr.Textbox(label="通用Prompt内容💬", show_copy_button = True),
                                  allow_flagging="never")
 
-    demo.queue().launch(share=True)
+    demo.queue(default_concurrency_limit=HANDLER_CONCURRENCY).launch(share=True)
+    session_manager.close()